@@ -20,6 +20,7 @@ setup(
     keywords='Lexer Parser',
     url='http://packages.python.org/syntax',
     packages=['syntax'],
+    extras_require={'vectorize': ['numpy']},
     long_description=read('README.md'),
     classifiers=[
         'Development Status :: 1 - Alpha',
@@ -1,4 +1,6 @@
+__version__ = '0.0.1'
+
 from .lexer import Lexer, State, LETTER, DIGIT, HEX, NEWLINE, _, Token, RegExp
-from .lexer import Character, Optional, word
+from .lexer import Character, Optional, word, Literals, TokenBuffer
 
 from .parser import Grammar, language
@@ -0,0 +1,311 @@
+#! /usr/bin/env python
+'''Generates a standalone lexer module out of a [syntax.lexer.State].
+
+The module holds the transition tables of the minimized automaton of every
+state the lexer can switch to, the token classes and one scanning loop, it
+does not import [syntax] nor build any [Language] at run time:
+
+    python -m syntax.codegen syntax.lang.python_lexer.Main python_tokens.py
+
+Only the actions set with [Rule.emit], [Rule.emit_then_switch_to],
+[Rule.switch_to] and [Rule.consume_then_switch_to] can be generated, they are
+described by their [Rule.effect]. Rules with custom actions can not.
+'''
+
+import importlib
+import sys
+
+from syntax import lexer
+
+
+class Generator(object):
+    '''Collects the states reachable from [initial_state], their automata and
+    tokens, and writes them out as Python source.
+    '''
+
+    def __init__(self, initial_state):
+        self.initial_state = initial_state
+        self.factories = []
+        self.ids = {}
+        self.states = []
+        self.automata = []
+        self.automaton_ids = {}
+        self.tokens = {}
+        self.keywords = []
+
+        self.state_id(initial_state)
+        index = 0
+        while index < len(self.factories):
+            self.states.append(self.build(self.factories[index]))
+            index += 1
+
+    def state_id(self, factory):
+        '''Returns the id of the state built by [factory], state ids follow
+        the order the states are found in.
+        '''
+        if factory not in self.ids:
+            self.ids[factory] = len(self.factories)
+            self.factories.append(factory)
+        return self.ids[factory]
+
+    def build(self, factory):
+        state = factory()
+        automaton = state.compile(minimize=True)
+        if automaton.classes.starts is None:
+            raise ValueError('Can not generate %r, its rules are built out of '
+                             'languages the generator does not know.' % state)
+        if automaton not in self.automaton_ids:
+            self.automaton_ids[automaton] = len(self.automata)
+            self.automata.append(automaton)
+
+        actions = []
+        for rule in state.rules:
+            effect = rule.effect
+            if effect is None:
+                if rule.action is not None:
+                    raise ValueError('Can not generate the custom action of '
+                                     '%r in %r.' % (rule, state))
+                actions.append(None)
+                continue
+
+            token = skip = keywords = target = None
+            if effect.token_creator is not None:
+                token, skip = self.token(effect.token_creator, effect.skip)
+            if effect.keywords:
+                keywords = len(self.keywords)
+                self.keywords.append(dict(
+                    (word, self.token(creator, effect.skip)[0])
+                    for word, creator in effect.keywords.items()))
+            if effect.new_state is not None:
+                target = self.state_id(effect.new_state)
+            actions.append((effect.kind, token, skip, keywords, target))
+        return self.automaton_ids[automaton], actions
+
+    def token(self, token_creator, skip):
+        '''Returns the name of the token class [token_creator] builds, and
+        whether its tokens are skipped.
+        '''
+        if isinstance(token_creator, lexer.TokenType):
+            cls = token_creator
+        else:
+            token = token_creator()
+            cls, skip = type(token), token.skip
+
+        name = cls.__name__
+        if self.tokens.setdefault(name, cls) is not cls:
+            raise ValueError('Two token classes are named %s.' % name)
+        return name, skip
+
+    def source(self, origin):
+        '''Returns the source of the lexer module, [origin] names what it was
+        generated from.
+        '''
+        lines = [HEADER % {'origin': origin}]
+
+        for name in sorted(self.tokens):
+            if name != 'Token':
+                lines.append('class %s(Token):\n    __slots__ = ()\n\n\n' %
+                             name)
+
+        lines.append('KIND = %r\n' % dict(
+            (kind, i) for i, kind in enumerate(KINDS)))
+
+        lines.append('\nKEYWORDS = [\n')
+        for keywords in self.keywords:
+            lines.append('    {%s},\n' % ', '.join(
+                '%r: %s' % (word, keywords[word]) for word in sorted(keywords)))
+        lines.append(']\n')
+
+        lines.append('\nAUTOMATA = [\n')
+        for automaton in self.automata:
+            lines.append(self.automaton(automaton))
+        lines.append(']\n')
+
+        lines.append('\nSTATES = [\n')
+        for automaton, actions in self.states:
+            lines.append('    (%d, (\n' % automaton)
+            for action in actions:
+                lines.append('        %s,\n' % self.action(action))
+            lines.append('    )),\n')
+        lines.append(']\n')
+
+        lines.append(SCANNER)
+        return ''.join(lines)
+
+    def automaton(self, automaton):
+        automaton.compile()
+        classes = automaton.classes
+        rows = [[automaton.step_class(index, klass)
+                 for klass in range(len(classes))]
+                for index in range(len(automaton))]
+
+        lines = ['    (%d,\n' % automaton.start, '     (\n']
+        for row in rows:
+            lines.append('      %r,\n' % (tuple(row[_] for _ in classes.table),))
+        lines.append('     ),\n     (\n')
+        for row in rows:
+            lines.append('      %r,\n' % (tuple(row),))
+        lines.append('     ),\n')
+        lines.append('     %r,\n' % (tuple(-1 if _ is None else _
+                                            for _ in automaton.accepts),))
+        lines.append('     %r,\n' % (tuple(classes.starts),))
+        lines.append('     %r),\n' % (tuple(classes.start_classes),))
+        return ''.join(lines)
+
+    def action(self, action):
+        if action is None:
+            return 'None'
+        kind, token, skip, keywords, target = action
+        return '(%d, %s, %r, %s, %r)' % (
+            KINDS.index(kind), token or 'None', bool(skip),
+            'None' if keywords is None else 'KEYWORDS[%d]' % keywords, target)
+
+
+KINDS = (lexer.EMIT, lexer.SWITCH, lexer.CONSUME)
+
+
+HEADER = '''\
+# Generated by syntax.codegen from %(origin)s, do not edit.
+\'\'\'A standalone lexer for %(origin)s, see [lex].
+\'\'\'
+
+from bisect import bisect_right
+
+
+class Token(object):
+    __slots__ = ('value', 'position', 'skip')
+
+    def __init__(self, value, position, skip=False):
+        self.value = value
+        self.position = position
+        self.skip = skip
+
+    def __repr__(self):
+        return '%%s(%%s:%%s)' %% (
+            self.__class__.__name__, self.value, self.position or '0')
+
+
+'''
+
+
+SCANNER = '''
+
+EMIT = KIND['emit']
+SWITCH = KIND['switch']
+CONSUME = KIND['consume']
+
+
+def lex(text):
+    \'\'\'Returns the tokens of [text].
+
+    Every lexer state runs its automaton from where the last token ended and
+    the last accepting state it reaches is dispatched, the input after it is
+    lexed again by the next state.
+
+    The automaton states read past the dispatched one are remembered with
+    their offset in [failures]: none of them leads to an accepting state, so
+    lexing that input again stops as soon as it gets to one of them rather
+    than reading as far again.
+    \'\'\'
+    tokens = []
+    state = 0
+    start = offset = position = 0
+    end = len(text)
+    failures = set()
+    failures_end = 0
+
+    while True:
+        automaton, actions = STATES[state]
+        index, ascii, transitions, accepts, starts, start_classes = \\
+            AUTOMATA[automaton]
+
+        checkpoint = rule = accepted = -1
+        i = offset
+        while i < end:
+            code = ord(text[i])
+            if code < 128:
+                index = ascii[index][code]
+            else:
+                index = transitions[index][
+                    start_classes[bisect_right(starts, code) - 1]]
+            if not index or (failures and
+                             (automaton, index, i + 1) in failures):
+                break
+            i += 1
+            if accepts[index] >= 0:
+                checkpoint = i
+                rule = accepts[index]
+                accepted = index
+
+        if checkpoint < 0:
+            if start == end:
+                return tokens
+            raise Exception('No rule defined for input [%s] at position '
+                            '%s.' % (text[start:i + 1], position))
+
+        if i > checkpoint:
+            if checkpoint > failures_end:
+                failures = set()
+            index = accepted
+            for j in range(checkpoint, i):
+                code = ord(text[j])
+                if code < 128:
+                    index = ascii[index][code]
+                else:
+                    index = transitions[index][
+                        start_classes[bisect_right(starts, code) - 1]]
+                failures.add((automaton, index, j + 1))
+            if i > failures_end:
+                failures_end = i
+
+        action = actions[rule]
+        if action is None:
+            raise Exception('No action for input [%s] at position %s.' %
+                            (text[start:checkpoint], position))
+
+        kind, token, skip, keywords, target = action
+        if kind == EMIT:
+            value = text[start:checkpoint]
+            if keywords:
+                token = keywords.get(value, token)
+            tokens.append(token(value, position, skip))
+            position += checkpoint - start
+            start = checkpoint
+        elif kind == CONSUME:
+            position += checkpoint - start
+            start = checkpoint
+        if target is not None:
+            state = target
+        offset = checkpoint
+'''
+
+
+def generate(initial_state, origin=None):
+    '''Returns the source of a lexer module for [initial_state], a [State]
+    class or a function returning a state.
+    '''
+    if origin is None:
+        origin = '%s.%s' % (initial_state.__module__, initial_state.__name__)
+    return Generator(initial_state).source(origin)
+
+
+def write(initial_state, path, origin=None):
+    '''Writes the lexer module for [initial_state] to [path].
+    '''
+    with open(path, 'w') as f:
+        f.write(generate(initial_state, origin))
+
+
+def main(argv):
+    if len(argv) != 3:
+        sys.stderr.write('usage: %s package.module.State output.py\n' %
+                         argv[0])
+        return 2
+
+    module, name = argv[1].rsplit('.', 1)
+    write(getattr(importlib.import_module(module), name), argv[2], argv[1])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -4,7 +4,7 @@ import re
 import sys
 
 from syntax import LETTER, DIGIT, _, State, RegExp, Lexer, Token, Character
-from syntax import Grammar, HEX, language, word, Optional
+from syntax import Grammar, HEX, language, word, Optional, TokenBuffer
 from syntax import parser
 
 
@@ -305,14 +305,14 @@ class Printer:
 
 
 def parse(filename):
-    out = Output()
+    out = TokenBuffer()
     lexer = Lexer(initial_state=Main, output=out)
-    lexer.lex(open(filename).read())
+    lexer.lex_file(filename)
 
     g = HtmlGrammar()
     d = g.main()
     ds = [d]
-    for i, token in enumerate(out.tokens):
+    for i, token in enumerate(out):
         try:
             d = d.derive(token)
             ds.append(d)
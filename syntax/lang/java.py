@@ -6,7 +6,7 @@ import sys
 # from parser import Grammar, TokenClass, _, language
 
 from syntax import LETTER, DIGIT, _, State, RegExp, Lexer, Token, Character
-from syntax import Grammar, HEX, language
+from syntax import Grammar, HEX, language, TokenBuffer
 
 identifier = (LETTER | '_') + (LETTER | DIGIT | '_') * _
 
@@ -56,25 +56,18 @@ class Main(State):
         super(Main, self).__init__()
         self.indentation = [0]
 
-        for keyword in keywords:
-            self / keyword / (lambda: Keyword())
+        self / tokens    / Token
+        self / operators / Token
 
-        for token in tokens:
-            self / token / (lambda: Token())
-
-        for operator in operators:
-            self / operator / (lambda: Token())
-
-        for boolean in ('true', 'false'):
-            self / boolean / (lambda: Boolean())
-
-        self / identifier         / (lambda: Identifier())
-        self / whitespace         / (lambda: Whitespace(skip=True))
-        self / comments           / (lambda: Comment(skip=True))
-        self / multiline_comments / (lambda: Comment(skip=True))
-        self / newline            / (lambda: NewLine(skip=True))
-        self / number             / (lambda: Number())
-        self / string             / (lambda: String())
+        reserved = dict.fromkeys(keywords, Keyword)
+        reserved.update(dict.fromkeys(('true', 'false'), Boolean))
+        self.on( identifier ).emit( Identifier, keywords=reserved )
+        self.on( whitespace         ).emit( Whitespace, skip=True )
+        self.on( comments           ).emit( Comment,    skip=True )
+        self.on( multiline_comments ).emit( Comment,    skip=True )
+        self.on( newline            ).emit( NewLine,    skip=True )
+        self / number     / Number
+        self / string     / String
 
 
 class JavaGrammar(Grammar):
@@ -176,10 +169,9 @@ class Output(object):
 
 
 if __name__ == '__main__':
-    out = Output()
+    out = TokenBuffer()
     lexer = Lexer(initial_state=Main, output=out)
-    lexer.lex(open(sys.argv[1]).read())
+    lexer.lex_file(sys.argv[1])
 
     g = JavaGrammar()
-    tokens = out.tokens #filter(lambda _: not isinstance(_, (Whitespace, NewLine, Comment)), out.tokens)
-    g.derive(tokens)
+    g.derive(out)
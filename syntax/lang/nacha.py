@@ -43,7 +43,7 @@ class FileHeaderRecord(object):
 class Main(State):
     def __init__(self):
         super(Main, self).__init__()
-        self / RegExp('.') / (lambda: Token())
+        self / RegExp('.') / Token
 
 
 class Output(object):
@@ -87,29 +87,24 @@ class Main(State):
         super(Main, self).__init__()
         self.indentation = [0]
 
-        for keyword in keywords:
-            self / keyword / (lambda: Keyword())
-
-        for token in tokens:
-            self / token / (lambda: Token())
-
-        for operator in operators:
-            self / operator / (lambda: Token())
-
-        self / identifier        / (lambda: Identifier())
-        self / whitespace        / (lambda: Whitespace())
-        self / comments          / (lambda: Comment())
-        self / line_continuation / (lambda: LineContinuation())
+        self / tokens            / Token
+        self / operators         / Token
+
+        self.on(identifier).emit(Identifier,
+                                 keywords=dict.fromkeys(keywords, Keyword))
+        self / whitespace        / Whitespace
+        self / comments          / Comment
+        self / line_continuation / LineContinuation
 #        self / stringliteral     /
-        self / shortstring       / (lambda: StringLiteral())
-        self / longstring        / (lambda: StringLiteral())
+        self / shortstring       / StringLiteral
+        self / longstring        / StringLiteral
 
 
-        self / integer           / (lambda: Integer())
-        self / longinteger       / (lambda: LongInteger())
+        self / integer           / Integer
+        self / longinteger       / LongInteger
 
         #self / newline    >> self.indent
-        self / newline    / (lambda: NewLine())
+        self / newline    / NewLine
 
 
     def indent(self, state, lexer):
@@ -163,5 +158,5 @@ if __name__ == '__main__':
     #lexer.lex(open(sys.argv[1]).read())
     #lexer.lex('\n                                   ')
 
-    l = PythonLexer(open(sys.argv[1]).read())
-    l.lex()
+    lexer = Lexer(initial_state=Main, output=Output())
+    lexer.lex_file(sys.argv[1])
@@ -1,15 +1,118 @@
+import codecs
+import collections
+import hashlib
+import io
+import itertools
+import marshal
+import mmap
+import os
 import re
+import sys
+import weakref
+from array import array
+from bisect import bisect_right
+
+# Only needed to lex with vectorize=True, see [load_numpy].
+numpy = None
+
+
+def load_numpy():
+    '''Imports NumPy the first time it is needed, returns None if it is not
+    installed.
+    '''
+    global numpy
+    if numpy is None:
+        try:
+            import numpy as module
+        except ImportError:
+            return None
+        numpy = module
+    return numpy
 
 
 class Language(object):
+    '''Base class of the lexer languages.
+
+    Languages are hash-consed: building a language out of the same arguments,
+    children being languages themselves, returns the same instance. Languages
+    can therefore be compared and cached by identity. The table is weak, a
+    language nothing refers to any more is freed.
+    '''
+
+    interned = weakref.WeakValueDictionary()
+    uids = itertools.count(1)
+
+    # Derivatives are memoized per language in an LRU of [cache_size]
+    # characters. Languages are shared, so are their caches, hits and misses
+    # are counted for all of them, see [cache_info].
+    cache_size = 256
+    derivatives = None
+    hits = 0
+    misses = 0
+
+    # Whether the language matches the empty string, it is known when the
+    # language is built so is_matchable() never walks the tree.
+    nullable = False
+
+    def __new__(cls, *args):
+        key = (cls,) + args
+        try:
+            return Language.interned[key]
+        except KeyError:
+            pass
+        except TypeError:  # Unhashable arguments, can not be shared.
+            language = super(Language, cls).__new__(cls)
+            language.uid = next(Language.uids)
+            return language
+
+        language = Language.interned[key] = super(Language, cls).__new__(cls)
+        language.uid = next(Language.uids)
+        return language
 
     def is_matchable(self):
-        return False
+        return self.nullable
 
     def derive(self, ch):
+        derivatives = self.derivatives
+        if derivatives is None:
+            derivatives = self.derivatives = collections.OrderedDict()
+
+        try:
+            derivative = derivatives[ch]
+        except KeyError:
+            Language.misses += 1
+            derivative = derivatives[ch] = self._derive(ch)
+            if len(derivatives) > self.cache_size:
+                derivatives.popitem(last=False)
+            return derivative
+
+        Language.hits += 1
+        derivatives.move_to_end(ch)
+        return derivative
+
+    def _derive(self, ch):
         raise Exception("Not Implemented. %s Trying to derive char:'%s'." %
                         (type(self), ch))
 
+    def derive_uncached(self, ch):
+        '''Returns the derivative on [ch] without memoizing it here, nor in
+        the [Or] and [And] nodes it is made of.
+
+        Those are the nodes whose derivatives are new combinations of the
+        others, see [Automaton]. The rest of the language is derived through
+        the caches: what is left of it is a part of the language it started
+        from.
+        '''
+        return self.derive(ch)
+
+    @staticmethod
+    def cache_info():
+        '''Returns the hits, misses and hit rate of the derivative caches.
+        '''
+        total = Language.hits + Language.misses
+        return CacheInfo(Language.hits, Language.misses,
+                         float(Language.hits) / total if total else 0.0)
+
     def __add__(self, other):
         _other = other
         if other is None:  # one or more '+_' syntax
@@ -27,6 +130,9 @@ class Language(object):
         return Star.make(self)
 
 
+CacheInfo = collections.namedtuple('CacheInfo', 'hits misses hit_rate')
+
+
 class Reject(Language):
     '''A [Language] that rejects everything.
     '''
@@ -41,8 +147,7 @@ class Match(Language):
     '''A [Language] that matches the defined [Language].
     '''
 
-    def is_matchable(self):
-        return True
+    nullable = True
 
     def derive(self, ch):
         return reject
@@ -55,6 +160,23 @@ reject = Reject()
 match = Match()
 
 
+class Tag(Language):
+    '''A [Language] that matches the empty string on behalf of the rule at
+    [index], see [tagged].
+    '''
+
+    nullable = True
+
+    def __init__(self, index):
+        self.index = index
+
+    def derive(self, ch):
+        return reject
+
+    def __repr__(self):
+        return 'Tag(%s)' % self.index
+
+
 class Character(Language):
     '''A [Language] that matches a specific character.
     '''
@@ -78,13 +200,15 @@ class Or(Language):
     def __init__(self, left, right):
         self.left = left
         self.right = right
+        self.nullable = left.nullable or right.nullable
 
-    def is_matchable(self):
-        return self.left.is_matchable() or self.right.is_matchable()
-
-    def derive(self, ch):
+    def _derive(self, ch):
         return Or.make(self.left.derive(ch), self.right.derive(ch))
 
+    def derive_uncached(self, ch):
+        return Or.make_all([_.derive_uncached(ch)
+                            for _ in Or.alternatives(self)])
+
     @staticmethod
     def make(left, right):
         if (left is reject and right is reject):
@@ -95,7 +219,42 @@ class Or(Language):
             return left
         if (left is match or right is match):
             return match
-        return Or(left, right)
+        if left is right:
+            return left
+
+        return Or.chain(set(Or.alternatives(left) + Or.alternatives(right)))
+
+    @staticmethod
+    def make_all(languages):
+        '''Returns the [Or] of all the [languages], what folding them with
+        [make] returns, in one go.
+        '''
+        alternatives = set()
+        for language in languages:
+            if language is match:
+                return match
+            if language is not reject:
+                alternatives.update(Or.alternatives(language))
+        if not alternatives:
+            return reject
+        return Or.chain(alternatives)
+
+    @staticmethod
+    def chain(alternatives):
+        # Normal form: a right nested chain of the distinct alternatives
+        # ordered by uid, so the same alternatives always make the same Or.
+        alternatives = sorted(alternatives, key=lambda _: _.uid)
+        language = alternatives.pop()
+        while alternatives:
+            language = Or(alternatives.pop(), language)
+        return language
+
+    @staticmethod
+    def alternatives(language):
+        if isinstance(language, Or):
+            return (Or.alternatives(language.left) +
+                    Or.alternatives(language.right))
+        return [language]
 
     def __repr__(self):
         return 'Or(%s, %s)' % (self.left, self.right)
@@ -108,17 +267,21 @@ class And(Language):
     def __init__(self, left, right):
         self.left = left
         self.right = right
+        self.nullable = left.nullable and right.nullable
 
-    def is_matchable(self):
-        return self.left.is_matchable() and self.right.is_matchable()
-
-    def derive(self, ch):
-        if self.left.is_matchable():
+    def _derive(self, ch):
+        if self.left.nullable:
             return Or.make(And.make(self.left.derive(ch), self.right),
                            self.right.derive(ch))
 
         return And.make(self.left.derive(ch), self.right)
 
+    def derive_uncached(self, ch):
+        left = And.make(self.left.derive_uncached(ch), self.right)
+        if self.left.nullable:
+            return Or.make(left, self.right.derive(ch))
+        return left
+
     @staticmethod
     def make(left, right):
         if left is match:
@@ -137,19 +300,20 @@ class Star(Language):
     '''A [Language] that matches the kleene star of a [Language].
     '''
 
+    nullable = True
+
     def __init__(self, language):
         self.language = language
 
-    def is_matchable(self):
-        return True
-
-    def derive(self, ch):
+    def _derive(self, ch):
         return And.make(self.language.derive(ch), Star.make(self.language))
 
     @staticmethod
     def make(language):
-        if language in [match, reject]:
+        if language in [match, reject] or isinstance(language, Star):
             return language
+        if isinstance(language, Optional):
+            return Star.make(language.language)
         return Star(language)
 
     def __repr__(self):
@@ -159,18 +323,18 @@ class Star(Language):
 class Optional(Language):
     '''A [Language] that matches zero or one of a [Language].
     '''
+    nullable = True
+
     def __init__(self, language):
         self.language = language
 
-    def is_matchable(self):
-        return True
-
-    def derive(self, ch):
+    def _derive(self, ch):
         return self.language.derive(ch)
 
     @staticmethod
     def make(language):
-        if language in [match, reject]:
+        if (language in [match, reject] or
+                isinstance(language, (Star, Optional))):
             return language
         return Optional(language)
 
@@ -186,7 +350,7 @@ class RegExp(Language):
         self._regex = regex
         self.regexp = re.compile(regex)
 
-    def derive(self, ch):
+    def _derive(self, ch):
         if self.regexp.match(ch):
             return match
         return reject
@@ -195,13 +359,55 @@ class RegExp(Language):
         return 'RE(%s)' % (self._regex)
 
 
+class Literals(Language):
+    '''A [Language] that matches any of a set of fixed [strings], such as
+    keywords or operators.
+
+    It is a trie: the derivative on a character is the set of what is left of
+    the strings starting with it, looked up in a dict built the first time the
+    node is derived.
+    '''
+
+    children = None
+
+    def __new__(cls, strings):
+        return super(Literals, cls).__new__(cls, frozenset(strings))
+
+    def __init__(self, strings):
+        self.strings = frozenset(strings)
+        self.nullable = '' in self.strings
+
+    def derive(self, ch):
+        children = self.children
+        if children is None:
+            suffixes = {}
+            for string in self.strings:
+                if string:
+                    suffixes.setdefault(string[0], set()).add(string[1:])
+            children = self.children = dict(
+                (_, Literals.make(suffixes[_])) for _ in suffixes)
+        return children.get(ch, reject)
+
+    @staticmethod
+    def make(strings):
+        strings = frozenset(strings)
+        if not strings:
+            return reject
+        if strings == frozenset(['']):
+            return match
+        return Literals(strings)
+
+    def __repr__(self):
+        return 'L(%s)' % '|'.join(sorted(self.strings))
+
+
 class Not(Language):
     '''Helper [Language] represents the revese of another [Language].
     '''
     def __init__(self, language):
         self.language = language
 
-    def derive(self, ch):
+    def _derive(self, ch):
         d = self.language.derive(c)
         if d is match:
             return reject
@@ -251,13 +457,33 @@ def to_language(thing):
     if isinstance(thing, Language):
         return thing
 
+    if isinstance(thing, (list, tuple, set, frozenset)):
+        return Literals.make(thing)
+
     if isinstance(thing, Rule):
         return thing.language
 
     raise "Couldn't convert [%s] to a Language" % thing
 
 
+# What the built-in actions of a [Rule] do, see [Rule.effect].
+EMIT = 'emit'
+SWITCH = 'switch'
+CONSUME = 'consume'
+
+Effect = collections.namedtuple('Effect',
+                                'kind token_creator skip keywords new_state')
+
+
 class Rule(object):
+    '''A [Language] and the action to take when it is matched.
+
+    Actions set with the methods below also leave their [Effect] in `effect`,
+    a description of the action that does not need running it, which is what
+    [syntax.codegen] generates code from. Custom actions leave it None.
+    '''
+
+    effect = None
 
     def __init__(self, language=None, action=None, root_rule=None):
         self.language = language
@@ -277,18 +503,36 @@ class Rule(object):
     def is_matchable(self):
         return self.language.is_matchable()
 
-    def emit(self, token_creator):
-        def action(state, lexer):
-            token = token_creator()
-            token.value = state.matched_input
-            token.position = lexer.position
-            return lexer.emit(token, state)
+    def emit(self, token_creator, skip=False, keywords=None):
+        '''Emits the matched input as a token of [token_creator].
+
+        [keywords] maps inputs to the token creator to use instead, so an
+        identifier rule can emit reserved words with one dict lookup rather
+        than a rule per keyword.
+        '''
+        create = token_factory(token_creator, skip)
+        self.effect = Effect(EMIT, token_creator, skip, keywords, None)
+
+        if keywords:
+            table = dict((word, token_factory(creator, skip))
+                         for word, creator in keywords.items())
+
+            def action(state, lexer):
+                value = state.matched_input
+                token = table.get(value, create)(value, lexer.position)
+                return lexer.emit(token, state)
+        else:
+            def action(state, lexer):
+                token = create(state.matched_input, lexer.position)
+                return lexer.emit(token, state)
         self.action = action
         return self.action
 
     def switch_to(self, new_state):
+        self.effect = Effect(SWITCH, None, False, None, new_state)
+
         def _action(state, lexer):
-            next_state = new_state()
+            next_state = lexer.instantiate(new_state)
             lexer.pop()
             lexer.push(new_state)
             next_state.matched_input = state.matched_input
@@ -297,20 +541,23 @@ class Rule(object):
         return self
 
     def consume_then_switch_to(self, new_state):
+        self.effect = Effect(CONSUME, None, False, None, new_state)
+
         def _action(state, lexer):
             lexer.position += len(state.matched_input)
-            next_state = new_state()
+            next_state = lexer.instantiate(new_state)
             lexer.pop()
             lexer.push(new_state)
             return next_state
         self.action = _action
         return self
 
-    def emit_then_switch_to(self, token_creator, new_state):
+    def emit_then_switch_to(self, token_creator, new_state, skip=False):
+        create = token_factory(token_creator, skip)
+        self.effect = Effect(EMIT, token_creator, skip, None, new_state)
+
         def action(state, lexer):
-            token = token_creator()
-            token.value = state.matched_input
-            token.position = lexer.position
+            token = create(state.matched_input, lexer.position)
             lexer.pop()
             lexer.push(new_state)
             return lexer.emit(token, state)
@@ -322,7 +569,11 @@ class Rule(object):
         '''
         return self.emit(token_creator)
 
+    __truediv__ = __div__
+
     def __rshift__(self, action):
+        self.effect = None
+
         def _action(state, lexer):
             next_state = action(state, lexer)
             next_state.matched_input = state.matched_input
@@ -333,28 +584,227 @@ class Rule(object):
         return 'Rule(%s)' % (self.language)
 
 
-class Token(object):
-    def __init__(self):
+class TokenType(type):
+    '''Metaclass of [Token]: token classes declared as `class Foo(Token):
+    pass` get empty `__slots__`, so tokens have no per instance `__dict__`.
+    '''
+
+    def __new__(mcs, name, bases, namespace):
+        namespace.setdefault('__slots__', ())
+        return super(TokenType, mcs).__new__(mcs, name, bases, namespace)
+
+
+class Token(TokenType('TokenBase', (object,), {})):
+    '''A lexed token: its value and the offset of its first character.
+
+    Tokens emitted by a [Lexer] also know the [LineIndex] of their input, so
+    their [line] and [column] are found with a bisect when asked for.
+    '''
+
+    __slots__ = ('value', 'position', 'skip', 'lines')
+
+    def __init__(self, skip=False):
         self.value = None
         self.position = None
-        self.skip = False
+        self.skip = skip
+        self.lines = None
 
-    def __new__(cls, skip=False):
-        def init(instance, skip=skip):
-            instance.skip = skip
+    @classmethod
+    def create(cls, value, position, skip=False):
+        '''Builds a token without going through `__init__`, this is what
+        rules naming a token class use for every token they emit.
+        '''
+        token = _new(cls)
+        token.value = value
+        token.position = position
+        token.skip = skip
+        token.lines = None
+        return token
+
+    @property
+    def line(self):
+        '''The line of the token, counted from 1, None if it is not known.
+        '''
+        if self.lines is None or self.position is None:
+            return None
+        return self.lines.line(self.position)
 
-        # TODO(Sam): This will replace the orginal __init__. We probably should
-        #            not do that and call this method too.
-        cls.__init__ = init
-        instance = super(Token, cls).__new__(cls)
-        return instance
+    @property
+    def column(self):
+        '''The column of the token in its [line], counted from 0.
+        '''
+        if self.lines is None or self.position is None:
+            return None
+        return self.lines.column(self.position)
 
     def __repr__(self):
         return '%s(%s:%s)' % (
             self.__class__.__name__, self.value, self.position or '0')
 
 
-class State:
+_new = object.__new__
+
+
+class Shifted(object):
+    '''Base of the offsets into an edited text that move after an edit
+    lazily: the entries from [pivot] on are [delta] characters off until
+    they are [settle]d.
+
+    Subclasses [shift] and [replace] their entries.
+    '''
+
+    pivot = 0
+    delta = 0
+
+    def shifted(self, offsets, index):
+        '''Returns the entry [index] of the [offsets] array, shifted.
+        '''
+        if index >= self.pivot:
+            return offsets[index] + self.delta
+        return offsets[index]
+
+    def splice(self, first, stop, added, delta):
+        '''Replaces the entries between [first, stop) with the [added] ones,
+        the entries after them moving by [delta] characters.
+        '''
+        if self.pivot < first:
+            self.shift(self.pivot, first, self.delta)
+        elif self.pivot > stop:
+            self.shift(stop, self.pivot, -self.delta)
+        self.pivot = first + self.replace(first, stop, added)
+        self.delta += delta
+
+    def settle(self, index):
+        '''Applies the pending shift to the entries up to [index].
+        '''
+        if index >= self.pivot:
+            self.shift(self.pivot, index + 1, self.delta)
+            self.pivot = index + 1
+
+
+class LineIndex(Shifted):
+    '''The offsets where the lines of an input start, in an array.
+
+    A [Lexer] adds to it the input as it comes, so it is the size of the
+    number of lines and a line or column lookup is one bisect. An [edit]
+    moves the lines after it lazily, see [Shifted].
+    '''
+
+    def __init__(self, text=''):
+        self.starts = array('q', [0])
+        self.pivot = 1
+        self.add(text, 0)
+
+    @staticmethod
+    def scan(text, offset):
+        '''Returns the line starts of [text], the input from [offset] on.
+        '''
+        starts = array('q')
+        find = text.find
+        append = starts.append
+        index = find('\n')
+        while index >= 0:
+            append(offset + index + 1)
+            index = find('\n', index + 1)
+        return starts
+
+    def add(self, text, offset):
+        '''Adds the line starts of [text], the input from [offset] on.
+        '''
+        self.settle(len(self.starts) - 1)
+        self.starts.extend(self.scan(text, offset))
+        self.pivot = len(self.starts)
+        self.delta = 0
+
+    def truncate(self, offset):
+        '''Forgets the lines that start past [offset].
+        '''
+        del self.starts[self.find(offset):]
+        self.pivot = min(self.pivot, len(self.starts))
+
+    def edit(self, offset, deleted, inserted):
+        '''Updates the index for the [deleted] characters at [offset] being
+        replaced with [inserted].
+        '''
+        self.splice(self.find(offset), self.find(offset + deleted),
+                    self.scan(inserted, offset), len(inserted) - deleted)
+
+    def replace(self, first, stop, added):
+        self.starts[first:stop] = added
+        return len(added)
+
+    def shift(self, start, stop, delta):
+        '''Moves the line starts between [start, stop) by [delta].
+        '''
+        if delta and start < stop:
+            self.starts[start:stop] = array(
+                'q', map(delta.__add__, self.starts[start:stop]))
+
+    def find(self, offset):
+        '''Returns the index of the first line starting after [offset].
+        '''
+        starts, pivot = self.starts, self.pivot
+        if pivot < len(starts) and starts[pivot] + self.delta <= offset:
+            return bisect_right(starts, offset - self.delta, pivot)
+        return bisect_right(starts, offset, 0, pivot)
+
+    def start(self, index):
+        return self.shifted(self.starts, index)
+
+    def line(self, offset):
+        '''Returns the line of [offset], counted from 1.
+        '''
+        return self.find(offset)
+
+    def column(self, offset):
+        '''Returns the column of [offset] in its line, counted from 0.
+        '''
+        return offset - self.start(self.find(offset) - 1)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        return (self.start(_) for _ in range(len(self.starts)))
+
+
+def token_factory(token_creator, skip=False):
+    '''Returns a function building a token out of its value and position.
+
+    [token_creator] is either a [Token] class, which takes the fast path of
+    [Token.create], or a function returning a new token, such as
+    `lambda: Keyword()`.
+    '''
+    if isinstance(token_creator, TokenType):
+        create = token_creator.create
+        return lambda value, position: create(value, position, skip)
+
+    def create_token(value, position):
+        token = token_creator()
+        token.value = value
+        token.position = position
+        return token
+    return create_token
+
+
+# What a state can still do with its input: nothing, match more of it or
+# dispatch it as a token.
+REJECT = 0
+CONTINUE = 1
+ACCEPT = 2
+
+
+def status_of(language):
+    '''Returns REJECT, CONTINUE or ACCEPT for a [language].
+    '''
+    if language is reject:
+        return REJECT
+    if language.nullable:
+        return ACCEPT
+    return CONTINUE
+
+
+class State(object):
 
     def __init__(self, matched_input='', rules=None):
         self.matched_input = matched_input
@@ -365,22 +815,41 @@ class State:
             return self.rules[0].is_match()
         return False
 
+    @property
+    def status(self):
+        return status_of(self.merged())
+
     def can_match_more(self):
-        return [(not _.is_reject()) for _ in self.rules]
+        return self.status != REJECT
 
     def has_exact_match(self):
-        return [_.is_match() for _ in self.rules]
+        return any([_.is_match() for _ in self.rules])
 
     def has_matchables(self):
-        return [_.is_matchable() for _ in self.rules]
+        return self.status == ACCEPT
 
     def is_reject(self):
-        return all([_.is_reject() for _ in self.rules])
+        return self.status == REJECT
 
     def next(self, ch, context):
-        derived_rules = [_.derive(ch) for _ in self.rules]
-        matching_rules = [_ for _ in derived_rules if not _.is_reject()]
-        return DerivedState(self.matched_input + ch, matching_rules)
+        language = self.merged().derive(ch)
+        return DerivedState(context, self.token_start(context),
+                            context.offset + len(ch), self, language,
+                            status_of(language))
+
+    def merged(self):
+        '''Returns the rules of this state merged into one [tagged]
+        language, a single derivative of it advances every rule.
+        '''
+        if self._merged is None:
+            self._merged = tagged([_.language for _ in self.rules])
+        return self._merged
+
+    def token_start(self, context):
+        '''Returns the input offset where the matched input of this state
+        starts, the input carried over by `switch_to` included.
+        '''
+        return context.offset - len(self.matched_input)
 
     def dispatch(self, context):
         exact_match = [_ for _ in self.rules if _.is_match()]
@@ -397,17 +866,22 @@ class State:
                             "or state creator function [%s], Matching: [%s]" %
                             (self.rules, self.matched_input))
 
+        return self.resolve(state_like, context)
+
+    def resolve(self, state_like, context):
+        '''Turns whatever a rule action returned into the next [State].
+        '''
         if isinstance(state_like, State):
             return state_like
 
         # At this point the matchedInput has been taken care of so we will
         # just reset it.
-        #context.top().matched_input = ''
-        return context.top()()
+        return context.instantiate(context.top())
 
     def on(self, thing):
         rule = Rule(language=to_language(thing))
         self.rules.append(rule)
+        self._merged = self._automata = None
         return rule
 
     def __truediv__(self, thing):
@@ -415,6 +889,41 @@ class State:
         '''
         return self.on(thing)
 
+    def compile(self, minimize=False):
+        '''Returns the [Automaton] for the rules of this state, [minimize]d
+        if asked to.
+
+        Automata are cached by the [merged] language, which is hash-consed,
+        so every state with the same rules shares one transition table.
+        '''
+        automata = self._automata
+        if automata is None:
+            automata = self._automata = {}
+
+        automaton = automata.get(minimize)
+        if automaton is None:
+            key = (self.merged(), minimize)
+            automaton = State.automata.get(key)
+            if automaton is None:
+                automaton = State.automata[key] = compiled(self.merged(),
+                                                           minimize)
+            automata[minimize] = automaton
+        return automaton
+
+    def scanner(self):
+        '''Returns the [Scanner] for the rules of this state, None if they
+        can not be scanned with a regular expression.
+        '''
+        language = self.merged()
+        if language not in State.scanners:
+            State.scanners[language] = Scanner.build(self)
+        return State.scanners[language]
+
+    automata = {}
+    scanners = {}
+    _automata = None
+    _merged = None
+
 
 class RejectState(State):
 
@@ -426,63 +935,1283 @@ class RejectState(State):
 
 
 class DerivedState(State):
+    '''A [State] in the middle of a token.
+
+    It holds the derivative of the [merged] language of `owner`, the [State]
+    the token started in, whose rules provide the action when it is
+    dispatched. It only keeps the [start, end) offsets of its input,
+    `matched_input` is sliced out of the lexer buffer the first time it is
+    asked for.
+    '''
+
+    status = REJECT
 
-    def __init__(self, matched_input, rules):
-        super(DerivedState, self).__init__(matched_input, rules)
+    def __init__(self, context, start, end, owner, language, status):
+        self.context = context
+        self.start = start
+        self.end = end
+        self.owner = owner
+        self.language = language
+        self.status = status
+        self._matched_input = None
+
+    @property
+    def matched_input(self):
+        if self._matched_input is None:
+            self._matched_input = self.context.slice(self.start, self.end)
+        return self._matched_input
+
+    @matched_input.setter
+    def matched_input(self, value):
+        self._matched_input = value
+
+    def must_accept(self):
+        return isinstance(self.language, Tag)
+
+    def has_exact_match(self):
+        return any([isinstance(_, Tag)
+                    for _ in Or.alternatives(self.language)])
+
+    def token_start(self, context):
+        return self.start
+
+    def memo_key(self):
+        '''Returns a key identifying this state at its offset, or None if
+        states of this kind can not be memoized.
+        '''
+        return (self.language, self.end)
+
+    def next(self, ch, context):
+        language = self.language.derive(ch)
+        return DerivedState(context, self.start, context.offset + len(ch),
+                            self.owner, language, status_of(language))
+
+    def rule_index(self):
+        '''Returns the index of the rule of `owner` to dispatch to.
+        '''
+        return winner(self.language)
+
+    def dispatch(self, context):
+        index = self.rule_index()
+        if index is None:
+            raise Exception("Something not right here .. should have state,"
+                            "or state creator function [%s], Matching: [%s]" %
+                            (self.language, self.matched_input))
+
+        state_like = self.owner.rules[index].action(self, context)
+        return self.resolve(state_like, context)
+
+
+class AutomatonState(DerivedState):
+    '''A [State] that steps through a compiled [Automaton] instead of deriving
+    its language.
+    '''
+
+    def __init__(self, automaton, index, owner, context, start, end):
+        super(AutomatonState, self).__init__(context, start, end, owner,
+                                             automaton.states[index],
+                                             automaton.status[index])
+        self.automaton = automaton
+        self.index = index
+
+    def must_accept(self):
+        return self.automaton.must_accept[self.index]
+
+    def memo_key(self):
+        return (self.automaton, self.index, self.end)
+
+    def next(self, ch, context):
+        index = self.automaton.step(self.index, ch)
+        if index is None:
+            # The automaton is out of budget, the lexer drops it and the rest
+            # of the token is derived.
+            context.flush(self.automaton)
+            return UncachedState.next(self, ch, context)
+        return AutomatonState(self.automaton, index, self.owner, context,
+                              self.start, context.offset + len(ch))
+
+    def rule_index(self):
+        return self.automaton.accepts[self.index]
+
+
+class UncachedState(DerivedState):
+    '''A [DerivedState] for the rest of a token whose lazy [Automaton] ran
+    out of budget, derived with [Language.derive_uncached] like the
+    automaton would have.
+    '''
+
+    def next(self, ch, context):
+        language = self.language.derive_uncached(ch)
+        return UncachedState(context, self.start, context.offset + len(ch),
+                             self.owner, language, status_of(language))
+
+
+class MatchedState(DerivedState):
+    '''A [State] for a token a [Scanner] matched, dispatched to [rule].
+    '''
+
+    status = ACCEPT
+
+    def __init__(self, context, start, end, owner, rule):
+        super(MatchedState, self).__init__(context, start, end, owner, None,
+                                           ACCEPT)
+        self.rule = rule
+
+    def rule_index(self):
+        return self.rule
+
+
+class Automaton(object):
+    '''A deterministic automaton compiled from the [merged] language of a
+    [State], growing up to [max_states] states as transitions are taken.
+    '''
+
+    DEAD = 0
+
+    def __init__(self, language, max_states=None):
+        self.max_states = max_states
+        self.classes = CharacterClasses(atoms([language]))
+        self.states = []
+        self.transitions = []
+        self.class_transitions = []
+        self.accepts = []
+        self.status = []
+        self.must_accept = []
+        self.index = {}
+
+        self.add(reject)
+        self.start = self.add(language)
+
+    @classmethod
+    def from_tables(cls, classes, states, index, start, transitions,
+                    class_transitions, accepts, status, must_accept):
+        '''Returns the complete automaton with the given tables, as
+        [minimize] and [load_automaton_tables] build them.
+        '''
+        automaton = cls.__new__(cls)
+        automaton.max_states = None
+        automaton.classes = classes
+        automaton.states = states
+        automaton.index = index
+        automaton.start = start
+        automaton.transitions = transitions
+        automaton.class_transitions = class_transitions
+        automaton.accepts = accepts
+        automaton.status = status
+        automaton.must_accept = must_accept
+        return automaton
+
+    def add(self, language):
+        '''Returns the index of the automaton state for [language], adding
+        it if it was not seen before.
+        '''
+        index = self.index.get(language)
+        if index is not None:
+            return index
+
+        index = self.index[language] = len(self.states)
+        self.states.append(language)
+        self.transitions.append({})
+        self.class_transitions.append({})
+        self.accepts.append(winner(language))
+        self.status.append(status_of(language))
+        self.must_accept.append(isinstance(language, Tag))
+        return index
+
+    def step(self, index, ch):
+        '''Returns the state reached from state [index] on [ch], None if the
+        automaton is full.
+        '''
+        transitions = self.transitions[index]
+        target = transitions.get(ch)
+        if target is None:
+            target = self.step_class(index, self.classes.of(ch))
+            if target is not None:
+                transitions[ch] = target
+        return target
+
+    def step_class(self, index, klass):
+        '''Returns the state reached from state [index] on any character of
+        the class [klass], deriving the state the first time. None if that
+        state is new and the automaton is full.
+        '''
+        transitions = self.class_transitions[index]
+        target = transitions.get(klass)
+        if target is None:
+            ch = self.classes.representatives[klass]
+            if self.max_states is None:
+                language = self.states[index].derive(ch)
+            else:
+                language = self.states[index].derive_uncached(ch)
+            target = self.index.get(language)
+            if target is None:
+                if self.is_full():
+                    return None
+                target = self.add(language)
+            transitions[klass] = target
+        return target
+
+    def is_full(self):
+        return (self.max_states is not None and
+                len(self.states) >= self.max_states)
+
+    def compile(self):
+        '''Builds every state reachable from the start state over the ASCII
+        character classes, other classes are added when they are first seen.
+        '''
+        index = self.start
+        while index < len(self.states):
+            for klass in range(len(self.classes)):
+                self.step_class(index, klass)
+            index += 1
+        return self
+
+    def minimize(self):
+        '''Returns the minimal automaton equivalent to this one.
+
+        States are merged with Hopcroft's partition refinement, starting from
+        blocks of states that dispatch to the same rule, so states with
+        distinct actions are never merged. Merging is only sound over the
+        whole alphabet: the classes are [CharacterClasses.complete]d first,
+        and an automaton whose classes can not be is returned as is.
+        '''
+        if not self.classes.complete():
+            return self
+        self.compile()
+
+        size = len(self.states)
+        klasses = range(len(self.classes))
+        inverse = [[[] for _ in range(size)] for _ in klasses]
+        for index in range(size):
+            for klass in klasses:
+                inverse[klass][self.step_class(index, klass)].append(index)
+
+        blocks = {}
+        for index in range(size):
+            key = (self.accepts[index], self.status[index],
+                   self.must_accept[index])
+            blocks.setdefault(key, set()).add(index)
+        blocks = list(blocks.values())
+        block_of = [0] * size
+        for i, block in enumerate(blocks):
+            for index in block:
+                block_of[index] = i
+
+        pending = set(range(len(blocks)))
+        while pending:
+            splitter = list(blocks[pending.pop()])
+            for klass in klasses:
+                touched = {}
+                for target in splitter:
+                    for index in inverse[klass][target]:
+                        touched.setdefault(block_of[index], set()).add(index)
+
+                for i, inside in touched.items():
+                    block = blocks[i]
+                    if len(inside) == len(block):
+                        continue
+                    outside = block - inside
+                    blocks[i] = inside
+                    blocks.append(outside)
+                    j = len(blocks) - 1
+                    for index in outside:
+                        block_of[index] = j
+                    if i in pending or len(outside) <= len(inside):
+                        pending.add(j)
+                    else:
+                        pending.add(i)
+
+        return self.quotient(blocks, block_of)
+
+    def quotient(self, blocks, block_of):
+        '''Returns the automaton whose states are the [blocks] of states of
+        this one, the block of the dead state first.
+        '''
+        order = sorted(range(len(blocks)), key=lambda _: min(blocks[_]))
+        renumber = dict((block, i) for i, block in enumerate(order))
+
+        states = []
+        class_transitions = []
+        accepts = []
+        status = []
+        must_accept = []
+        for block in order:
+            first = min(blocks[block])
+            states.append(self.states[first])
+            class_transitions.append(dict(
+                (klass, renumber[block_of[target]])
+                for klass, target in self.class_transitions[first].items()))
+            accepts.append(self.accepts[first])
+            status.append(self.status[first])
+            must_accept.append(self.must_accept[first])
+        index = dict((language, renumber[block_of[i]])
+                     for language, i in self.index.items())
+        return Automaton.from_tables(
+            self.classes, states, index, renumber[block_of[self.start]],
+            [{} for _ in order], class_transitions, accepts, status,
+            must_accept)
+
+    def __len__(self):
+        return len(self.states)
+
+
+class CharacterClasses(object):
+    '''Partitions characters into the classes a set of languages can not
+    tell apart.
+
+    Derivatives only look at the input through their [atoms], the
+    [Character]s and [RegExp]s of the languages, so characters all atoms
+    agree on have the same derivatives. The classes of ASCII characters are
+    worked out up front into [table], other characters are classified the
+    first time they are seen. Without atoms every character is its own class.
+    '''
+
+    def __init__(self, atoms):
+        self.atoms = atoms
+        self.ids = {}
+        self.representatives = []
+        self.cache = {}
+        self.table = [self.classify(chr(_)) for _ in range(128)]
+        self.starts = None
+        self.start_classes = None
+
+    def signature(self, ch):
+        if self.atoms is None:
+            return ch
+        return tuple([_.derive(ch) is match for _ in self.atoms])
+
+    def classify(self, ch):
+        signature = self.signature(ch)
+        klass = self.ids.get(signature)
+        if klass is None:
+            klass = self.ids[signature] = len(self.representatives)
+            self.representatives.append(ch)
+        return klass
+
+    def of(self, ch):
+        '''Returns the class id of the character [ch].
+        '''
+        if len(ch) == 1:
+            code = ord(ch)
+            if code < 128:
+                return self.table[code]
+            if self.starts is not None:
+                return self.start_classes[bisect_right(self.starts, code) - 1]
+        klass = self.cache.get(ch)
+        if klass is None:
+            klass = self.cache[ch] = self.classify(ch)
+        return klass
+
+    def complete(self):
+        '''Works out the class of every character, returns False if it can
+        not be done because the atoms are unknown.
+
+        Characters past ASCII are classified by ranges, [starts] being the
+        first character of each range: a range ends where an atom starts or
+        stops matching, found with one scan of all the characters per
+        [RegExp] atom.
+        '''
+        if self.starts is not None:
+            return True
+        if self.atoms is None:
+            return False
+
+        bounds = set([128])
+        for atom in self.atoms:
+            if isinstance(atom, Character):
+                if len(atom.char) == 1 and ord(atom.char) >= 128:
+                    bounds.update([ord(atom.char), ord(atom.char) + 1])
+            elif not atom.regexp.match(''):
+                runs = re.compile('(?:%s)+' % atom._regex)
+                for run in runs.finditer(unicode_characters()):
+                    bounds.update([run.start() + 128, run.end() + 128])
+        bounds.discard(sys.maxunicode + 1)
+
+        starts = []
+        start_classes = []
+        for start in sorted(bounds):
+            klass = self.classify(chr(start))
+            if not start_classes or start_classes[-1] != klass:
+                starts.append(start)
+                start_classes.append(klass)
+        self.starts = array('l', starts)
+        self.start_classes = start_classes
+        return True
+
+    def __len__(self):
+        return len(self.representatives)
+
+
+_unicode_characters = []
+
+
+def unicode_characters():
+    '''Returns a string of every character past ASCII, built once.
+    '''
+    if not _unicode_characters:
+        _unicode_characters.append(
+            ''.join(map(chr, range(128, sys.maxunicode + 1))))
+    return _unicode_characters[0]
+
+
+def atoms(languages):
+    '''Returns the distinct [Character]s and [RegExp]s of [languages], the
+    characters of [Literals] included, or None if one of them is built out of
+    a language it does not know.
+    '''
+    found = {}
+    seen = set([match, reject])
+    pending = list(languages)
+    while pending:
+        language = pending.pop()
+        if language in seen:
+            continue
+        seen.add(language)
+        if isinstance(language, (Or, And)):
+            pending.extend([language.left, language.right])
+        elif isinstance(language, (Star, Optional)):
+            pending.append(language.language)
+        elif type(language) in (Character, RegExp):
+            found[language] = True
+        elif isinstance(language, Literals):
+            for string in language.strings:
+                for ch in string:
+                    found[Character(ch)] = True
+        elif isinstance(language, Tag):
+            continue
+        else:
+            return None
+    return sorted(found, key=lambda _: _.uid)
+
+
+def tagged(languages):
+    '''Returns [languages] merged into one language, each of them followed
+    by the [Tag] of its index.
+
+    The tags are what is left of a language once it matched, so the
+    alternatives of a derivative of the merged language tell which rules
+    match exactly, a bare [Tag], and which ones can match, a nullable
+    alternative ending in a [Tag]. Languages that are the same apart from
+    their tag stay distinct alternatives.
+    '''
+    language = reject
+    for i, _ in enumerate(languages):
+        language = Or.make(language, And.make(_, Tag(i)))
+    return language
+
+
+def winner(language):
+    '''Returns the index of the rule [State.dispatch] picks out of a
+    [tagged] [language]: the first exact match, otherwise the first rule that
+    can match. None if no rule can be dispatched.
+    '''
+    exact = []
+    matchable = []
+    for alternative in Or.alternatives(language):
+        if isinstance(alternative, Tag):
+            exact.append(alternative.index)
+        elif alternative.nullable:
+            matchable.append(alternative.right.index)
+    if exact:
+        return min(exact)
+    if matchable:
+        return min(matchable)
+    return None
+
+
+class Scanner(object):
+    '''Matches the tokens of a [State] with one `re` pattern, the rules that
+    can not be translated to it falling back to an [Automaton] each.
+    '''
+
+    def __init__(self, pattern, automaton, fallbacks):
+        self.pattern = pattern
+        self.automaton = automaton
+        self.groups = [(int(name[1:]), group)
+                       for name, group in pattern.groupindex.items()]
+        self.fallbacks = fallbacks
+
+    @staticmethod
+    def build(state):
+        '''Returns the [Scanner] for the rules of [state], or None if one of
+        them can not be translated.
+        '''
+        automaton = state.compile(minimize=True)
+        classes = automaton.classes
+        if classes.starts is None:
+            return None
+
+        masks = dict((atom, set(klass for signature, klass in
+                                classes.ids.items()
+                                if isinstance(signature, tuple) and
+                                signature[i]))
+                     for i, atom in enumerate(classes.atoms))
+        lookaheads = []
+        fallbacks = []
+        for i, rule in enumerate(state.rules):
+            regex = translate(rule.language, masks)
+            if regex is not None:
+                lookaheads.append('(?:(?=(?P<r%d>%s)))?' % (i, regex))
+            else:
+                fallbacks.append((i, compiled(tagged([rule.language]))))
+        if not lookaheads:
+            return None
+        try:
+            pattern = re.compile(''.join(lookaheads))
+        except (re.error, OverflowError, RecursionError):
+            return None
+        return Scanner(pattern, automaton, fallbacks)
+
+    def match(self, text, offset):
+        '''Returns the end of the token at [offset] in [text] and the index
+        of the rule it is dispatched to, None if no rule matches.
+        '''
+        regs = self.pattern.match(text, offset).regs
+        best = offset
+        rules = []
+        for i, group in self.groups:
+            end = regs[group][1]
+            if end > best:
+                best = end
+                rules = [i]
+            elif end == best and rules:
+                rules.append(i)
+
+        for i, automaton in self.fallbacks:
+            end = longest(automaton, text, offset)
+            if end > best:
+                best = end
+                rules = [i]
+            elif end == best and rules:
+                rules.append(i)
+
+        if not rules:
+            return None
+        if len(rules) == 1:
+            return best, rules[0]
+
+        automaton = self.automaton
+        index = automaton.start
+        for ch in text[offset:best]:
+            index = automaton.step(index, ch)
+        return best, automaton.accepts[index]
+
+
+def longest(automaton, text, offset):
+    '''Returns where the longest match of [automaton] in [text] from
+    [offset] ends, [offset] if there is none.
+    '''
+    step = automaton.step
+    accepts = automaton.accepts
+    index = automaton.start
+    end = offset
+    for i in range(offset, len(text)):
+        index = step(index, text[i])
+        if not index:
+            break
+        if accepts[index] is not None:
+            end = i + 1
+    return end
+
+
+# What the regular expression of a [RegExp] atom can be for it to be translated
+# as is: a class, an escape or a character, each matching one character.
+SINGLE_CHARACTER = re.compile(r'''
+    \[ \^? \]? (?: \\. | [^]\\[] )* \]
+    | \\ [^\dbBAZ]
+    | [^\\()[\]{}*+?|^$]
+    ''', re.VERBOSE | re.DOTALL)
+
+
+def translate(language, masks):
+    '''Returns the regular expression for a rule [language], or None if it
+    can not be translated so that `re` matches it the way derivatives do.
+
+    [masks] holds the character classes every atom matches.
+    '''
+    if isinstance(language, Literals):
+        return '(?:%s)' % '|'.join(
+            re.escape(_) for _ in sorted(language.strings,
+                                         key=lambda _: (-len(_), _)))
+    if language is reject:
+        return '(?!)'
+
+    positions = []
+    follow = {}
+    found = glushkov(language, positions, follow)
+    if found is None:
+        return None
+
+    for candidates in [found[1]] + list(follow.values()):
+        candidates = sorted(candidates)
+        for i, p in enumerate(candidates):
+            for q in candidates[i + 1:]:
+                if masks[positions[p]] & masks[positions[q]]:
+                    return None
+    return regex(language)
+
+
+def glushkov(language, positions, follow):
+    '''Returns whether [language] is nullable and its first and last
+    positions, an atom occurrence being a position. [positions] gets the atom
+    of every position and [follow] the positions that can follow each one.
+    None if the language is not built out of atoms, [Or], [And], [Star] and
+    [Optional].
+
+    Also None for an [Or] with a nullable alternative and for a nullable
+    [Star] or [Optional] body: `re` takes the first alternative or iteration
+    that lets the whole pattern match, which can be an empty one where
+    derivatives go on to match more.
+    '''
+    if language is match:
+        return True, set(), set()
+    if type(language) in (Character, RegExp):
+        if type(language) is Character and len(language.char) != 1:
+            return None
+        if type(language) is RegExp and not SINGLE_CHARACTER.fullmatch(
+                language._regex):
+            return None
+        position = len(positions)
+        positions.append(language)
+        follow[position] = set()
+        return False, set([position]), set([position])
+
+    parts = [glushkov(_, positions, follow) for _ in children(language)]
+    if not parts or None in parts:
+        return None
+
+    if isinstance(language, Or):
+        (left_nullable, left_first, left_last), (
+            right_nullable, right_first, right_last) = parts
+        if left_nullable or right_nullable:
+            return None
+        return False, left_first | right_first, left_last | right_last
+    if isinstance(language, And):
+        (left_nullable, left_first, left_last), (
+            right_nullable, right_first, right_last) = parts
+        for position in left_last:
+            follow[position] |= right_first
+        return (left_nullable and right_nullable,
+                left_first | right_first if left_nullable else left_first,
+                left_last | right_last if right_nullable else right_last)
+
+    nullable, first, last = parts[0]
+    if nullable:
+        return None
+    if isinstance(language, Star):
+        for position in last:
+            follow[position] |= first
+    return True, first, last
+
+
+def regex(language):
+    if language is match:
+        return ''
+    if isinstance(language, Character):
+        return re.escape(language.char)
+    if isinstance(language, RegExp):
+        return language._regex
+    if isinstance(language, Or):
+        return '(?:%s|%s)' % (regex(language.left), regex(language.right))
+    if isinstance(language, And):
+        return regex(language.left) + regex(language.right)
+    if isinstance(language, Star):
+        return '(?:%s)*' % regex(language.language)
+    return '(?:%s)?' % regex(language.language)
+
+
+class Runs(object):
+    '''Finds the runs of characters of [text] that automaton states loop
+    on, so the lexer steps over a run at once instead of a character at a
+    time.
+
+    The text is turned into the ids of its distinct characters once, in the
+    smallest integer type they fit in, and shared by all the automata: a
+    character below 256 is its own id, the others are numbered after. The
+    ends of the runs of a state are then every offset whose character leaves
+    the state, found with numpy.flatnonzero the first time the state is
+    asked about.
+    '''
+
+    def __init__(self, text):
+        self.size = len(text)
+        self.classes = {}
+        self.stops = {}
+
+        codes = numpy.frombuffer(text.encode('utf-32-le', 'surrogatepass'),
+                                 numpy.uint32)
+        others = codes >= 256
+        if not others.any():
+            self.characters = range(256)
+            self.ids = codes.astype(numpy.uint8)
+            return
+
+        unique, inverse = numpy.unique(codes[others], return_inverse=True)
+        self.characters = list(range(256)) + unique.tolist()
+        self.ids = codes.astype(numpy.uint16 if len(self.characters) <= 65536
+                                else numpy.uint32)
+        self.ids[others] = inverse + 256
+
+    def end(self, automaton, index, offset):
+        '''Returns the end of the run from [offset] of the characters state
+        [index] of [automaton] steps back to itself on.
+        '''
+        stops = self.stops.get((automaton, index))
+        if stops is None:
+            classes = self.classes.get(automaton)
+            if classes is None:
+                of = automaton.classes.of
+                classes = self.classes[automaton] = numpy.array(
+                    [of(chr(_)) for _ in self.characters], numpy.intp)
+            loops = numpy.array([automaton.step_class(index, _) == index
+                                 for _ in range(len(automaton.classes))])
+            stops = self.stops[automaton, index] = numpy.flatnonzero(
+                ~loops[classes][self.ids])
+        i = numpy.searchsorted(stops, offset)
+        return int(stops[i]) if i < len(stops) else self.size
+
+
+def compiled(language, minimize=False):
+    '''Returns the compiled, [minimize]d if asked to, [Automaton] for the
+    [tagged] [language].
+
+    Automata are kept in [CACHE_DIRECTORY], if set, under a hash of the
+    structure of the language and of the code of the library, so a process
+    lexing with the same rules loads the tables rather than compiling them
+    again, and a change to the rules or to the library compiles them anew.
+    '''
+    path = cache_path(language, minimize)
+    if path is not None:
+        automaton = load_automaton(path)
+        if automaton is not None:
+            return automaton
+
+    automaton = Automaton(language).compile()
+    if minimize:
+        automaton = automaton.minimize()
+    if path is not None:
+        save_automaton(automaton, path)
+    return automaton
+
+
+# Where compiled automata are kept, None not to keep them. The cache is off
+# unless SYNTAX_CACHE_DIR names a directory.
+CACHE_DIRECTORY = os.environ.get('SYNTAX_CACHE_DIR') or None
+
+# Bumped whenever the layout of the cached tables changes.
+CACHE_FORMAT = 1
+
+# The hash of the source of this module, see [code_digest].
+CODE_DIGEST = None
+
+
+def code_digest():
+    '''Returns a hash of the source of this module, so editing the lexer
+    invalidates the cache even when the version number stays the same.
+    '''
+    global CODE_DIGEST
+    if CODE_DIGEST is None:
+        with open(__file__, 'rb') as f:
+            CODE_DIGEST = hashlib.sha1(f.read()).hexdigest()
+    return CODE_DIGEST
+
+
+def cache_path(language, minimize):
+    '''Returns the cache file of the automaton for [language], or None if it
+    is not to be cached.
+    '''
+    if not CACHE_DIRECTORY:
+        return None
+    structure = digest(language, {})
+    if structure is None:
+        return None
+
+    from syntax import __version__
+    key = repr((CACHE_FORMAT, __version__, code_digest(),
+                tuple(sys.version_info[:2]), marshal.version, bool(minimize),
+                structure))
+    return os.path.join(CACHE_DIRECTORY,
+                        hashlib.sha1(key.encode('utf-8')).hexdigest() + '.dfa')
+
+
+def digest(language, memo):
+    '''Returns a hash of the structure of [language], or None if it is built
+    out of a language it does not know.
+
+    The alternatives of an [Or] are hashed in the order of their own hashes,
+    not of their uids, so the same rules hash the same whatever order
+    languages were built in.
+    '''
+    if language in memo:
+        return memo[language]
+
+    if isinstance(language, Or):
+        parts = [digest(_, memo) for _ in Or.alternatives(language)]
+        structure = None if None in parts else ('or', sorted(parts))
+    elif isinstance(language, (And, Star, Optional)):
+        parts = [digest(_, memo) for _ in children(language)]
+        structure = None if None in parts else (kind(language), parts)
+    else:
+        structure = leaf(language)
+
+    if structure is not None:
+        structure = hashlib.sha1(repr(structure).encode('utf-8')).hexdigest()
+    memo[language] = structure
+    return structure
+
+
+def kind(language):
+    return NODE_KINDS.get(type(language))
+
+
+def children(language):
+    if isinstance(language, (Or, And)):
+        return [language.left, language.right]
+    if isinstance(language, (Star, Optional)):
+        return [language.language]
+    return []
+
+
+def leaf(language):
+    '''Returns what a language without children is made of, None if it is
+    not a language that can be cached.
+    '''
+    node_kind = kind(language)
+    if node_kind in ('reject', 'match'):
+        return (node_kind,)
+    if node_kind == 'tag':
+        return (node_kind, language.index)
+    if node_kind == 'character':
+        return (node_kind, language.char)
+    if node_kind == 'regexp':
+        return (node_kind, language._regex)
+    if node_kind == 'literals':
+        return (node_kind, tuple(sorted(language.strings)))
+    return None
+
+
+NODE_KINDS = {Reject: 'reject', Match: 'match', Tag: 'tag',
+              Character: 'character', RegExp: 'regexp', Literals: 'literals',
+              Or: 'or', And: 'and', Star: 'star', Optional: 'optional'}
+
+
+def dump_languages(languages):
+    '''Returns the nodes of [languages], children before their parents,
+    and the index of every language among them. None if one of them can not
+    be dumped.
+    '''
+    ids = {}
+    nodes = []
+    for root in languages:
+        pending = [root]
+        while pending:
+            language = pending[-1]
+            if language in ids:
+                pending.pop()
+                continue
+            if kind(language) is None:
+                return None
+
+            missing = [_ for _ in children(language) if _ not in ids]
+            if missing:
+                pending.extend(missing)
+                continue
+
+            pending.pop()
+            if children(language):
+                node = (kind(language),) + tuple(
+                    ids[_] for _ in children(language))
+            else:
+                node = leaf(language)
+            ids[language] = len(nodes)
+            nodes.append(node)
+    return nodes, ids
+
+
+def load_languages(nodes):
+    '''Returns the languages of the [nodes] written by [dump_languages].
+
+    They are rebuilt with the [make] constructors: the normal form of an
+    [Or] depends on the uids of its alternatives, which are not those of the
+    process that wrote the nodes.
+    '''
+    languages = []
+    for node in nodes:
+        node_kind = node[0]
+        if node_kind == 'reject':
+            language = reject
+        elif node_kind == 'match':
+            language = match
+        elif node_kind == 'tag':
+            language = Tag(node[1])
+        elif node_kind == 'character':
+            language = Character(node[1])
+        elif node_kind == 'regexp':
+            language = RegExp(node[1])
+        elif node_kind == 'literals':
+            language = Literals.make(node[1])
+        elif node_kind == 'or':
+            language = Or.make(languages[node[1]], languages[node[2]])
+        elif node_kind == 'and':
+            language = And.make(languages[node[1]], languages[node[2]])
+        elif node_kind == 'star':
+            language = Star.make(languages[node[1]])
+        else:
+            language = Optional.make(languages[node[1]])
+        languages.append(language)
+    return languages
+
+
+def dump_automaton(automaton):
+    '''Returns the tables of [automaton] as plain data for [marshal], or
+    None if its languages can not be dumped.
+    '''
+    classes = automaton.classes
+    dumped = dump_languages(list(automaton.states) + list(automaton.index) +
+                            list(classes.atoms or []))
+    if dumped is None:
+        return None
+
+    nodes, ids = dumped
+    return {
+        'nodes': nodes,
+        'states': [ids[_] for _ in automaton.states],
+        'index': [(ids[_], i) for _, i in automaton.index.items()],
+        'start': automaton.start,
+        'transitions': automaton.transitions,
+        'class_transitions': automaton.class_transitions,
+        'accepts': automaton.accepts,
+        'status': automaton.status,
+        'must_accept': automaton.must_accept,
+        'atoms': (None if classes.atoms is None else
+                  [ids[_] for _ in classes.atoms]),
+        'ids': classes.ids,
+        'representatives': classes.representatives,
+        'cache': classes.cache,
+        'table': classes.table,
+        'starts': None if classes.starts is None else list(classes.starts),
+        'start_classes': classes.start_classes,
+    }
+
+
+def load_automaton_tables(tables):
+    '''Returns the [Automaton] of the [tables] written by [dump_automaton].
+    '''
+    languages = load_languages(tables['nodes'])
+
+    classes = CharacterClasses.__new__(CharacterClasses)
+    classes.atoms = (None if tables['atoms'] is None else
+                     [languages[_] for _ in tables['atoms']])
+    classes.ids = tables['ids']
+    classes.representatives = tables['representatives']
+    classes.cache = tables['cache']
+    classes.table = tables['table']
+    classes.starts = (None if tables['starts'] is None else
+                      array('l', tables['starts']))
+    classes.start_classes = tables['start_classes']
+
+    return Automaton.from_tables(
+        classes, [languages[_] for _ in tables['states']],
+        dict((languages[_], i) for _, i in tables['index']), tables['start'],
+        tables['transitions'], tables['class_transitions'], tables['accepts'],
+        tables['status'], tables['must_accept'])
+
+
+def load_automaton(path):
+    '''Returns the [Automaton] cached at [path], None if there is none or
+    it can not be read.
+    '''
+    try:
+        with open(path, 'rb') as f:
+            return load_automaton_tables(marshal.load(f))
+    except (IOError, OSError, EOFError, ValueError, TypeError, KeyError,
+            IndexError):
+        return None
+
+
+def save_automaton(automaton, path):
+    '''Caches [automaton] at [path], the file is replaced as a whole so
+    concurrent processes never read half of it. Failing to write it is not an
+    error, the automaton is compiled again next time.
+    '''
+    tables = dump_automaton(automaton)
+    if tables is None:
+        return
+
+    temporary = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(temporary, 'wb') as f:
+            marshal.dump(tables, f)
+        os.rename(temporary, path)
+    except (IOError, OSError):
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+
+DERIVATIVE = 'derivative'
+DFA = 'dfa'
+LAZY = 'lazy'
+REGEX = 'regex'
+
+# The number of automaton states a [LAZY] lexer keeps per lexer state.
+MAX_DFA_STATES = 10000
+
+
+class TokenTooLong(Exception):
+    '''Raised when a token outgrows the input window of the [Lexer].
+    '''
+
+    def __init__(self, position, size, max_token_size):
+        super(TokenTooLong, self).__init__(
+            'Token at position %s is %s characters long, longer than the '
+            'max_token_size of %s.' % (position, size, max_token_size))
+        self.position = position
+        self.size = size
+        self.max_token_size = max_token_size
 
 
 class Lexer(object):
+    '''Lexes input with the rules of [initial_state] and the states it
+    switches to, adding the tokens to [output].
+    '''
 
-    def __init__(self, initial_state=None, output=None):
+    def __init__(self, initial_state=None, output=None, mode=DFA,
+                 max_token_size=None, max_dfa_states=MAX_DFA_STATES,
+                 minimize=False, vectorize=False, index_lines=False):
+        if vectorize and load_numpy() is None:
+            raise ImportError('Lexing with vectorize=True needs NumPy.')
         self.initial_state = initial_state or State
         self.output = output
-
-        self.current_state = self.initial_state()
-        self.last_matching_state = None
+        self.mode = mode
+        self.max_token_size = max_token_size
+        self.max_dfa_states = max_dfa_states
+        self.minimize = minimize
+        self.vectorize = vectorize
+        self.index_lines = index_lines
+        self.lines = LineIndex() if index_lines else None
+
+        self.states = {}
+        self.automata = {}
+        self.flushes = 0
+        self.restart([self.instantiate(self.initial_state)], 0)
+
+    def restart(self, stack, offset):
+        '''Resets the lexer to lex the input from [offset] on with the states
+        of [stack], as it was at a token boundary there.
+        '''
+        if self.index_lines:
+            self.lines.truncate(offset)
+        self.stack = list(stack)
+        top = self.stack[-1]
+        state = top if isinstance(top, State) else self.instantiate(top)
+        state.matched_input = ''
         self.last_dispatchable_state = None
-        self.stack = [self.current_state]
-        self.position = 0
-        self.remaining_input = None
+        self.trail = []
+        self.failures = set()
+        self.failures_end = 0
+        self.runs = None
+        self.buffer = ''
+        self.base = offset
+        self.offset = offset
+        self.position = offset
+        self.reach = offset
+        self.current_state = self.enter(state)
+
+    def scan(self, final=False):
+        '''Lexes the buffered input from the current offset.
+
+        This is one loop: rewinding to a checkpoint only moves the offset
+        back, so the stack depth does not depend on the input. With [final]
+        the end of the buffer is the end of the input and whatever is left is
+        dispatched, otherwise lexing stops there until more input comes.
+        '''
+        end = self.base + len(self.buffer)
+        scanning = final and self.mode == REGEX
+
+        while True:
+            if scanning and self.offset < end and self.match_token():
+                continue
+
+            if self.offset < end:
+                ch = self.buffer[self.offset - self.base]
+            elif final:
+                ch = ''
+            else:
+                return
+
+            state = self.current_state.next(ch, self)
+            status = state.status
+            if ch and status and not (self.failures and
+                                      state.memo_key() in self.failures):
+                self.offset += 1
+                if self.vectorize and not self.failures:
+                    state = self.skip_run(state)
+                self.current_state = state
+                if status == ACCEPT:
+                    self.checkpoint(state)
+                else:
+                    self.trail.append(state)
+                continue
+
+            checkpoint = self.last_dispatchable_state
+            if not ch and state.start == state.end:
+                return  # Done, and no token was started.
+            if checkpoint is None:
+                raise Exception('No rule defined for input [%s] at %s.' %
+                                (state.matched_input,
+                                 self.where(self.position)))
+
+            # Maximal munch: dispatch the last accepting state and rewind the
+            # input to where it ended. Nothing reached after it can be
+            # accepted, remember that so the input we lex again fails as soon
+            # as it gets there.
+            for _ in self.trail:
+                key = _.memo_key()
+                if key is not None:
+                    self.failures.add(key)
+            self.failures_end = max(self.failures_end, self.offset)
+            # Tokens depend on the input up to [reach], see [Document].
+            self.reach = max(self.reach, self.offset + 1)
+
+            self.check_size(checkpoint.start, checkpoint.end)
+            self.offset = checkpoint.end
+            self.last_dispatchable_state = None
+            self.trail = []
+            self.current_state = self.enter(checkpoint.dispatch(self))
+
+    def match_token(self):
+        '''Lexes the token at the offset with the [Scanner] of the current
+        state, returns False if it can not and the token is to be lexed a
+        character at a time.
+        '''
+        state = self.current_state
+        if (self.trail or self.last_dispatchable_state is not None or
+                not isinstance(state, AutomatonState)):
+            return False
+        scanner = state.owner.scanner()
+        if scanner is None:
+            return False
+        found = scanner.match(self.buffer, self.offset - self.base)
+        if found is None:
+            return False
+
+        end = found[0] + self.base
+        self.check_size(state.start, end)
+        self.reach = self.base + len(self.buffer) + 1
+        self.offset = end
+        matched = MatchedState(self, state.start, end, state.owner, found[1])
+        self.current_state = self.enter(matched.dispatch(self))
+        return True
 
-    def next(self, ch):
-        self.current_state = self.current_state.next(ch, self)
-        if self.current_state.has_exact_match():
-            self.last_matching_state = self.current_state
-            self.last_dispatchable_state = self.current_state
-            return self.current_state
+    def skip_run(self, state):
+        '''Returns [state] moved to the end of the run it is in, if it
+        stepped back to the automaton state it came from.
 
-        else:
-            if self.current_state.can_match_more():
-                self.last_matching_state = self.current_state
-                if self.current_state.has_matchables():
-                    self.last_dispatchable_state = self.current_state
-                return self.current_state
-
-            if self.last_matching_state is not None:
-                if self.last_matching_state.has_matchables():
-                    self.remaining_input = self.get_remaining_input(
-                        self.current_state, self.last_matching_state)
-                    self.current_state = self.last_matching_state.dispatch(self)
-                else:
-                    self.remaining_input = self.get_remaining_input(
-                        self.current_state, self.last_dispatchable_state)
-                    self.current_state = self.last_dispatchable_state.dispatch(self)
+        Runs are not skipped once the lexer has failures to check, those are
+        remembered per offset.
+        '''
+        previous = self.current_state
+        if not (isinstance(state, AutomatonState) and
+                isinstance(previous, AutomatonState) and
+                state.index == previous.index and
+                state.automaton is previous.automaton):
+            return state
+
+        automaton = state.automaton
+        if self.runs is None:
+            self.runs = Runs(self.buffer)
+        end = self.runs.end(automaton, state.index,
+                            self.offset - self.base) + self.base
+        if end == self.offset:
+            return state
+        self.offset = end
+        return AutomatonState(automaton, state.index, state.owner, self,
+                              state.start, end)
+
+    def check_size(self, start, end):
+        '''Raises [TokenTooLong] if the input between [start, end) does not
+        fit in the window.
+        '''
+        if self.max_token_size is not None and end - start > self.max_token_size:
+            raise TokenTooLong(self.position, end - start,
+                               self.max_token_size)
 
-                self.last_matching_state = None
-                self.last_dispatchable_state = None
+    def checkpoint(self, state):
+        '''Records [state] as the last accepting state.
+        '''
+        self.last_dispatchable_state = state
+        self.trail = []
+        if self.failures and state.end > self.failures_end:
+            self.failures = set()
+
+    def instantiate(self, factory):
+        '''Returns the [State] built by [factory], a state class or a function
+        such as `lambda: String('"')`.
+
+        Every factory is called once per lexer and its state is reused after
+        that, so the rules a state builds in `__init__` are not rebuilt for
+        every token.
+        '''
+        state = self.states.get(factory)
+        if state is None:
+            state = self.states[factory] = factory()
+        state.matched_input = ''
+        return state
 
-                for c in self.remaining_input:
-                    self.current_state = self.next(c)
+    def enter(self, state):
+        '''Prepares a freshly dispatched [state] for lexing.
 
-                return self.current_state
+        In [DFA] and [LAZY] modes the state is swapped for its automaton, in
+        [DERIVATIVE] mode it is derived character by character as is.
+        '''
+        if self.mode == DERIVATIVE or isinstance(state, AutomatonState):
+            return state
+        automaton = self.automaton(state)
+        return AutomatonState(automaton, automaton.start, state, self,
+                              state.token_start(self), self.offset)
+
+    def automaton(self, state):
+        '''Returns the [Automaton] of [state], the shared compiled one in
+        [DFA] mode, minimized with [minimize], a lazy one of this lexer in
+        [LAZY] mode.
+        '''
+        if self.mode != LAZY:
+            return state.compile(self.minimize)
+
+        language = state.merged()
+        automaton = self.automata.get(language)
+        if automaton is None:
+            automaton = self.automata[language] = Automaton(
+                language, self.max_dfa_states)
+        return automaton
+
+    def flush(self, automaton):
+        '''Drops the lazy [automaton] once it is full, states still stepping
+        through it keep it until they are done.
+        '''
+        language = automaton.states[automaton.start]
+        if self.automata.get(language) is automaton:
+            del self.automata[language]
+            self.flushes += 1
 
-        raise Exception('No rule defined for input [%s] at position %s.' % (
-            self.current_state.matched_input, self.position))
+    def slice(self, start, end):
+        '''Returns the input between the [start, end) offsets.
+        '''
+        return self.buffer[start - self.base:end - self.base]
 
-    def get_remaining_input(self, left, right):
-        return re.sub('^' + re.escape(right.matched_input), '', left.matched_input)
+    def where(self, position):
+        '''Describes [position] for error messages, with its line and column
+        if they are known.
+        '''
+        if self.lines is None:
+            return 'position %s' % position
+        return 'position %s (line %s, column %s)' % (
+            position, self.lines.line(position), self.lines.column(position))
 
     def emit(self, token, state):
+        token.lines = self.lines
         self.output.add(token)
         self.position += len(state.matched_input)
         state.matched_input = ''
@@ -502,9 +2231,533 @@ class Lexer(object):
         '''Tells the lexer that we are done feeding charachters and match what
         ever is remaining.
         '''
-        self.next('')
+        self.scan(final=True)
+
+    def feed(self, chunk, final=False):
+        '''Adds [chunk] to the input and lexes as much of it as can be lexed
+        without knowing what comes next, all of it if it is the [final] chunk.
+
+        Only the input of the token being matched is kept from the previous
+        chunks, a token can span any number of chunks.
+        '''
+        start = self.current_state.token_start(self)
+        self.buffer = self.buffer[start - self.base:] + chunk
+        self.base = start
+        self.runs = None
+        if self.index_lines:
+            self.lines.add(chunk, self.base + len(self.buffer) - len(chunk))
+        self.scan(final)
+        self.check_size(self.current_state.token_start(self), self.offset)
 
     def lex(self, input_string):
-        for c in input_string:
-            self.next(c)
+        self.feed(input_string, final=True)
+
+    def tokenize(self, chunks, encoding='utf-8'):
+        '''Lexes an iterable of string or bytes [chunks], for example a file
+        read in blocks, and yields every token as soon as it is final.
+
+        Bytes are decoded with [encoding], a character split between two
+        chunks is fine. While tokenizing, tokens go to the caller instead of
+        the lexer output.
+        '''
+        output = self.output
+        self.output = tokens = Tokens()
+        try:
+            for chunk in decode(chunks, encoding):
+                self.feed(chunk)
+                for token in tokens:
+                    yield token
+                del tokens[:]
+
+            self.done()
+            for token in tokens:
+                yield token
+        finally:
+            self.output = output
+
+    def lex_file(self, path, encoding='utf-8', chunk_size=None):
+        '''Lexes the file at [path] out of a memory map of it.
+
+        The mapped bytes are decoded a chunk at a time, the file is never
+        read into memory as a whole.
+        '''
+        for chunk in decode(map_file(path, chunk_size), encoding):
+            self.feed(chunk)
         self.done()
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+def map_file(path, chunk_size=None):
+    '''Memory maps the file at [path] and yields its bytes in chunks of
+    [chunk_size].
+    '''
+    chunk_size = chunk_size or CHUNK_SIZE
+    with open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for i in range(0, len(data), chunk_size):
+                yield data[i:i + chunk_size]
+        finally:
+            data.close()
+
+
+def decode(chunks, encoding='utf-8'):
+    '''Yields string [chunks] as they are and decodes bytes chunks with
+    [encoding], a character may be split between two chunks.
+    '''
+    decoder = None
+    for chunk in chunks:
+        if isinstance(chunk, bytes):
+            if decoder is None:
+                decoder = codecs.getincrementaldecoder(encoding)()
+            chunk = decoder.decode(chunk)
+        yield chunk
+
+    if decoder is not None:
+        yield decoder.decode(b'', True)
+
+
+class Tokens(list):
+    '''Lexer output that collects the tokens in a list.
+    '''
+
+    def add(self, token):
+        self.append(token)
+
+
+class TokenBuffer(object):
+    '''Lexer output that stores tokens in parallel arrays instead of keeping
+    a [Token] object for each of them.
+
+    Every token is a type id, its position, the [start, end) offsets of its
+    value in the buffer text and its skip flag. The values themselves are
+    written to one text buffer. [Token]s are only created when indexing or
+    iterating. The arrays can be wrapped without a copy, e.g. with
+    `numpy.frombuffer(buffer.starts, 'q')`.
+    '''
+
+    def __init__(self):
+        self.types = array('H')
+        self.positions = array('q')
+        self.starts = array('q')
+        self.ends = array('q')
+        self.skips = array('B')
+        self.token_types = []
+        self.type_ids = {}
+        self._text = io.StringIO()
+        self._length = 0
+        self._value = ''
+        self.lines = None
+
+    def type_id(self, token_type):
+        type_id = self.type_ids.get(token_type)
+        if type_id is None:
+            type_id = self.type_ids[token_type] = len(self.token_types)
+            self.token_types.append(token_type)
+        return type_id
+
+    def add(self, token):
+        value = token.value or ''
+        self.lines = token.lines
+        self.types.append(self.type_id(type(token)))
+        self.positions.append(token.position or 0)
+        self.starts.append(self._length)
+        self._length += len(value)
+        self.ends.append(self._length)
+        self.skips.append(bool(token.skip))
+        self._text.write(value)
+
+    def extend(self, other, start=0, stop=None):
+        '''Appends the tokens of the [other] buffer between [start, stop),
+        a slice of each array at a time.
+        '''
+        if stop is None:
+            stop = len(other)
+        if start >= stop:
+            return
+
+        ids = [self.type_id(_) for _ in other.token_types]
+        types = other.types[start:stop]
+        if ids != list(range(len(ids))):
+            types = array('H', map(ids.__getitem__, types))
+        first, last = other.starts[start], other.ends[stop - 1]
+        shift = self._length - first
+
+        self.types.extend(types)
+        self.positions.extend(other.positions[start:stop])
+        self.starts.extend(map(shift.__add__, other.starts[start:stop]))
+        self.ends.extend(map(shift.__add__, other.ends[start:stop]))
+        self.skips.extend(other.skips[start:stop])
+        self._text.write(other.text()[first:last])
+        self._length += last - first
+
+    def __getstate__(self):
+        return dict(self.__dict__, _text=None, _value=self.text())
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._text = io.StringIO()
+        self._text.write(self._value)
+
+    def text(self):
+        '''Returns the values of all the tokens as one string.
+        '''
+        if len(self._value) != self._length:
+            self._value = self._text.getvalue()
+        return self._value
+
+    def value(self, index):
+        return self.text()[self.starts[index]:self.ends[index]]
+
+    def __len__(self):
+        return len(self.types)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        token = self.token_types[self.types[index]].create(
+            self.value(index), self.positions[index], bool(self.skips[index]))
+        token.lines = self.lines
+        return token
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def significant(self):
+        '''Yields the tokens that are not skipped, without creating the
+        others.
+        '''
+        for index in range(len(self)):
+            if not self.skips[index]:
+                yield self[index]
+
+
+class Resynchronized(Exception):
+    '''Raised by [Document.add] to stop lexing once the new tokens line up
+    with the old ones again, after the old token [index].
+    '''
+
+    def __init__(self, index):
+        super(Resynchronized, self).__init__(index)
+        self.index = index
+
+
+class Document(Shifted):
+    '''The tokens of a text, kept up to date as the text is [edit]ed by
+    lexing again only around the edit.
+    '''
+
+    def __init__(self, text='', initial_state=None, chunk_size=4096,
+                 **options):
+        self.chunk_size = chunk_size
+        self.lexer = Lexer(initial_state=initial_state, output=self,
+                           index_lines=False, **options)
+        self.initial_stack = tuple(self.lexer.stack)
+        self.text = ''
+        self.lines = self.lexer.lines = LineIndex()
+        self._tokens = []
+        self.ends = array('q')
+        self.reaches = array('q')
+        self.stacks = []
+        self.lookahead = 1
+        self.dirty = None
+        self.added = None
+        self.resync = None
+        self.edit(0, 0, text)
+
+    def edit(self, offset, deleted, inserted):
+        '''Replaces the [deleted] characters at [offset] with [inserted] and
+        lexes again the tokens that may have changed.
+
+        Returns the index of the first token lexed again, how many old tokens
+        were replaced from there and how many new tokens replaced them.
+        '''
+        text = self.text[:offset] + inserted + self.text[offset + deleted:]
+        delta = len(inserted) - deleted
+        first = self.first_changed(offset)
+        if first:
+            start, stack = self.end(first - 1), self.stacks[first - 1]
+        else:
+            start, stack = 0, self.initial_stack
+
+        self.added = ([], array('q'), array('q'), [])
+        self.resync = (offset + len(inserted), delta,
+                       first if self.dirty is None else self.dirty)
+        self.lines.edit(offset, deleted, inserted)
+        stop = len(self._tokens)
+        error = None
+        lexer = self.lexer
+        lexer.restart(stack, start)
+        try:
+            for chunk in range(start, len(text), self.chunk_size):
+                lexer.feed(text[chunk:chunk + self.chunk_size])
+            lexer.done()
+        except Resynchronized as e:
+            stop = e.index + 1
+        except Exception as e:
+            error = e
+            stop = max(self.following(max(offset + deleted,
+                                          lexer.offset - delta)),
+                       self.dirty or 0)
+        finally:
+            added, self.added, self.resync = self.added, None, None
+
+        self.splice(first, stop, added, delta)
+        self.text = text
+        self.dirty = None if error is None else first + len(added[0])
+        if error is not None:
+            raise error
+        return first, stop - first, len(added[0])
+
+    def add(self, token):
+        lexer = self.lexer
+        end = lexer.offset
+        stack = None
+        if token.position + len(token.value or '') == end:
+            stack = tuple(lexer.stack)
+
+        tokens, ends, reaches, stacks = self.added
+        tokens.append(token)
+        ends.append(end)
+        reaches.append(lexer.reach)
+        stacks.append(stack)
+        self.lookahead = max(self.lookahead, lexer.reach - end)
+        lexer.reach = end
+
+        edited, delta, first = self.resync
+        if stack is not None and end >= edited:
+            index = self.find(end - delta) - 1
+            if (index >= first and self.end(index) == end - delta and
+                    self.stacks[index] == stack):
+                raise Resynchronized(index)
+
+    def first_changed(self, offset):
+        '''Returns the index of the first token that read the input at
+        [offset] or past it, or the first [dirty] one if it is before, moved
+        back to the first one after a boundary the lexer can restart from.
+        '''
+        first = index = self.find(offset)
+        # Only a token ending less than [lookahead] before the offset can
+        # have read that far.
+        while index and self.end(index - 1) + self.lookahead > offset:
+            index -= 1
+            if self.reach(index) > offset:
+                first = index
+        if self.dirty is not None:
+            first = min(first, self.dirty)
+        while first and self.stacks[first - 1] is None:
+            first -= 1
+        return first
+
+    def find(self, offset):
+        '''Returns the index of the first token ending after [offset].
+        '''
+        lo, hi = 0, len(self._tokens)
+        while lo < hi:
+            middle = (lo + hi) // 2
+            if self.end(middle) <= offset:
+                lo = middle + 1
+            else:
+                hi = middle
+        return lo
+
+    def following(self, offset):
+        '''Returns the index of the first token lexed from [offset] or past
+        it.
+        '''
+        index = self.find(offset)
+        start = self.end(index - 1) if index else 0
+        if index < len(self._tokens) and start < offset:
+            index += 1
+        return index
+
+    def end(self, index):
+        return self.shifted(self.ends, index)
+
+    def reach(self, index):
+        return self.shifted(self.reaches, index)
+
+    def replace(self, first, stop, added):
+        tokens, ends, reaches, stacks = added
+        self._tokens[first:stop] = tokens
+        self.ends[first:stop] = ends
+        self.reaches[first:stop] = reaches
+        self.stacks[first:stop] = stacks
+        return len(tokens)
+
+    def shift(self, start, stop, delta):
+        '''Moves the tokens between [start, stop) by [delta] characters.
+        '''
+        if not delta:
+            return
+        for index in range(start, stop):
+            self._tokens[index].position += delta
+            self.ends[index] += delta
+            self.reaches[index] += delta
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        self.settle(index)
+        return self._tokens[index]
+
+    def __iter__(self):
+        self.settle(len(self) - 1)
+        return iter(self._tokens)
+
+
+PIECE_SIZE = 4 * 1024 * 1024
+
+
+class Piece(object):
+    '''Lexer output for a piece of the input lexed by [lex_parallel].
+
+    The tokens go to a [TokenBuffer], and the token boundaries where the
+    lexer is back in the stack it started with are recorded: their offsets
+    in [offsets] and the number of tokens before them in [counts]. Lexing
+    stops at the first of them in [stops] or at or past [limit].
+    '''
+
+    def __init__(self, lexer, limit=None, stops=()):
+        self.lexer = lexer
+        self.limit = limit
+        self.stops = stops
+        self.tokens = TokenBuffer()
+        self.offsets = array('q')
+        self.counts = array('q')
+        self.initial = self.states()
+
+    def states(self):
+        '''Returns the states of the lexer stack, factories being resolved
+        to the state the lexer built with them.
+        '''
+        states = self.lexer.states
+        return tuple([_ if isinstance(_, State) else states.get(_)
+                      for _ in self.lexer.stack])
+
+    def add(self, token):
+        self.tokens.add(token)
+        lexer = self.lexer
+        end = lexer.offset
+        if (token.position + len(token.value or '') == end and
+                self.states() == self.initial):
+            self.offsets.append(end)
+            self.counts.append(len(self.tokens))
+            if end in self.stops or (self.limit is not None and
+                                     end >= self.limit):
+                raise Resynchronized(len(self.tokens))
+
+
+def lex_piece(initial_state, options, chunks, offset, final, limit=None,
+              stops=(), guess=False):
+    '''Lexes [chunks], the input from [offset] on and all the rest of it if
+    [final], from [initial_state], see [Piece] for [limit] and [stops].
+
+    Returns the tokens, the offsets and token counts of the boundaries back
+    in [initial_state], where lexing ended and the number of tokens up to
+    there. Lexing ends at the last such boundary when the input runs out
+    before the end, or when the lexer fails on a [guess]ed start.
+    '''
+    lexer = Lexer(initial_state=initial_state,
+                  **dict(options, index_lines=False))
+    piece = lexer.output = Piece(lexer, limit, stops)
+    lexer.restart(lexer.stack, offset)
+    try:
+        for chunk in chunks:
+            lexer.feed(chunk)
+        if final:
+            lexer.done()
+            return (piece.tokens, piece.offsets, piece.counts, lexer.offset,
+                    len(piece.tokens))
+    except Resynchronized:
+        pass
+    except Exception:
+        if not guess:
+            raise
+
+    if not piece.offsets:
+        return piece.tokens, piece.offsets, piece.counts, offset, 0
+    return (piece.tokens, piece.offsets, piece.counts, piece.offsets[-1],
+            piece.counts[-1])
+
+
+def chunks_of(text, start, size=CHUNK_SIZE):
+    for offset in range(start, len(text), size):
+        yield text[offset:offset + size]
+
+
+def lex_parallel(text, initial_state=None, processes=None,
+                 piece_size=PIECE_SIZE, boundary='(?m)^', **options):
+    '''Lexes [text] in a pool of [processes] and returns its tokens in a
+    [TokenBuffer], [options] being those of [Lexer].
+
+    The text is split into pieces of about [piece_size] characters where
+    [boundary] matches, places the lexer is likely to be in [initial_state]:
+    the start of a line for Python or Java, a `<` for HTML. Every piece is
+    lexed on its own as if it started in [initial_state], reading into the
+    next piece until it is back in that state, and reports the token
+    boundaries where it is.
+
+    The pieces are then stitched in order: the tokens of a piece are taken
+    from the boundary where the tokens before it ended, if the piece has one
+    there. Otherwise its start was a wrong guess and the input is lexed
+    again from that boundary until it lines up with one of the piece or
+    goes past it.
+    '''
+    pattern = re.compile(boundary)
+    starts = [0]
+    while starts[-1] + piece_size < len(text):
+        found = pattern.search(text, starts[-1] + piece_size)
+        if found is None or found.start() >= len(text):
+            break
+        starts.append(found.start())
+    limits = starts[1:] + [len(text)]
+
+    jobs = [(initial_state, options, [text[start:limit + CHUNK_SIZE]],
+             start, limit + CHUNK_SIZE >= len(text), limit, (), True)
+            for start, limit in zip(starts, limits)]
+    if len(jobs) == 1:
+        results = [lex_piece(*jobs[0])]
+    else:
+        import concurrent.futures  # Only lex_parallel needs it.
+        with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+            results = list(pool.map(lex_piece, *zip(*jobs)))
+
+    tokens = TokenBuffer()
+    offset = 0
+    for start, (piece, offsets, counts, end, count) in zip(starts, results):
+        if offset > end or (offset == end and offset != start):
+            continue
+
+        index = bisect_right(offsets, offset) - 1
+        if offset == start:
+            first = 0
+        elif index >= 0 and offsets[index] == offset:
+            first = counts[index]
+        else:
+            stops = set(offsets[index + 1:])
+            fixed, _, _, offset, fixed_count = lex_piece(
+                initial_state, options, chunks_of(text, offset), offset,
+                True, end, stops)
+            tokens.extend(fixed, 0, fixed_count)
+            if offset not in stops:
+                continue
+            first = counts[bisect_right(offsets, offset) - 1]
+
+        tokens.extend(piece, first, count)
+        offset = end
+
+    if offset < len(text):
+        rest = lex_piece(initial_state, options, chunks_of(text, offset),
+                         offset, True)
+        tokens.extend(rest[0])
+    tokens.lines = LineIndex(text)
+    return tokens
@@ -476,6 +476,9 @@ class Grammar(_Builder):
         raise "Must be overriden and specifies entrypoint grammer."
 
     def derive(self, tokens):
+        if isinstance(tokens, lexer.TokenBuffer):
+            tokens = tokens.significant()
+
         d = self.main()
         for t in tokens:
             if not t.skip:
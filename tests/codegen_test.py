@@ -0,0 +1,86 @@
+import os
+import sys
+import tempfile
+import unittest
+from syntax import codegen
+from syntax import lexer
+from syntax.lang import python_lexer
+from lexer_test import SOURCE, Arrows, Plain, Quote, Word, lex, tokens_of
+
+
+def load(state, name):
+    '''Writes the generated lexer for [state] and imports it.
+    '''
+    with tempfile.TemporaryDirectory() as directory:
+        codegen.write(state, os.path.join(directory, name + '.py'))
+        sys.path.insert(0, directory)
+        try:
+            return __import__(name)
+        finally:
+            sys.path.remove(directory)
+
+
+class Space(lexer.Token): pass
+
+
+class Spaced(lexer.State):
+
+    def __init__(self):
+        super(Spaced, self).__init__()
+        self.on(' ').emit(Space, skip=True)
+        self.on(lexer.RegExp('[^ ]') + lexer._).emit(
+            Word, keywords={'if': Quote})
+
+
+class Custom(lexer.State):
+
+    def __init__(self):
+        super(Custom, self).__init__()
+        self.on('a') >> (lambda state, lexer: lexer.top())
+
+
+class TestCodegen(unittest.TestCase):
+
+    def test_same_tokens(self):
+        module = load(python_lexer.Main, 'generated_python_lexer')
+        source = SOURCE + u"s = 'caf\u00e9'\n"
+        self.assertEqual(tokens_of(module.lex(source)), lex(source))
+
+    def test_switching_states(self):
+        module = load(Plain, 'generated_plain_lexer')
+        source = u'if a"b c"d \u00e9"'
+        self.assertEqual(tokens_of(module.lex(source)), lex(source, Plain))
+
+    def test_skips_and_keywords(self):
+        module = load(Spaced, 'generated_spaced_lexer')
+        source = u'if a  iffy \u00e9'
+        out = lexer.Tokens()
+        lexer.Lexer(initial_state=Spaced, output=out).lex(source)
+        tokens = module.lex(source)
+        self.assertEqual(tokens_of(tokens), tokens_of(out))
+        self.assertEqual([_.skip for _ in tokens], [_.skip for _ in out])
+
+    def test_near_misses_stay_linear(self):
+        module = load(Arrows, 'generated_arrows_lexer')
+        reads = [0]
+
+        def counting_ord(ch):
+            reads[0] += 1
+            return ord(ch)
+
+        module.ord = counting_ord
+        self.assertEqual(len(module.lex('-' * 2000)), 2000)
+        self.assertTrue(reads[0] < 10 * 2000, reads[0])
+
+    def test_standalone(self):
+        source = codegen.generate(python_lexer.Main)
+        imports = [_ for _ in source.splitlines()
+                   if _.startswith(('import ', 'from '))]
+        self.assertEqual(imports, ['from bisect import bisect_right'])
+
+    def test_custom_action(self):
+        self.assertRaises(ValueError, codegen.generate, Custom)
+
+
+if __name__ == '__main__':
+    unittest.main()
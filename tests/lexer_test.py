@@ -0,0 +1,910 @@
+import gc
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+import unittest
+from syntax import lexer
+from syntax import parser
+from syntax.lang import python_lexer
+
+
+SOURCE = '''def foo(bar, baz=12):
+    # a comment
+    if bar <= baz and not bar:
+        return "it's" + 'x'
+    print(bar, 0x1f, 0o17)
+'''
+
+
+class Output(object):
+    def __init__(self):
+        self.tokens = []
+
+    def add(self, token):
+        self.tokens.append(token)
+
+
+def tokens_of(tokens):
+    return [(type(_).__name__, _.value, _.position) for _ in tokens]
+
+
+def imported_with_syntax(module):
+    '''Returns whether importing syntax imports [module], in a new process.
+    '''
+    output = subprocess.check_output(
+        [sys.executable, '-c', 'import sys, syntax; print(%r in sys.modules)'
+         % module],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    return output.strip() == b'True'
+
+
+def lex(source, state=python_lexer.Main, **kwargs):
+    out = Output()
+    lexer.Lexer(initial_state=state, output=out, **kwargs).lex(source)
+    return tokens_of(out.tokens)
+
+
+def setUpModule():
+    # Compiled automata go to a directory of this run, never to the cache of
+    # the user.
+    global directory
+    directory = tempfile.TemporaryDirectory()
+    os.environ['SYNTAX_CACHE_DIR'] = lexer.CACHE_DIRECTORY = directory.name
+
+
+def tearDownModule():
+    del os.environ['SYNTAX_CACHE_DIR']
+    lexer.CACHE_DIRECTORY = None
+    directory.cleanup()
+
+
+class TestAutomaton(unittest.TestCase):
+
+    def test_dfa_matches_derivatives(self):
+        self.assertEqual(lex(SOURCE, mode=lexer.DFA),
+                         lex(SOURCE, mode=lexer.DERIVATIVE))
+
+    def test_keyword_priority(self):
+        self.assertEqual(lex('if iffy'),
+                         [('Keyword', 'if', 0),
+                          ('Whitespace', ' ', 2),
+                          ('Identifier', 'iffy', 3)])
+
+    def test_states_share_automaton(self):
+        self.assertTrue(python_lexer.Main().compile() is
+                        python_lexer.Main().compile())
+
+    def test_long_token(self):
+        source = "'''" + 'x' * 100000 + "'''"
+        self.assertEqual(lex(source), [('StringLiteral', source, 0)])
+
+    def test_dead_state(self):
+        automaton = python_lexer.Main().compile()
+        self.assertEqual(automaton.step(automaton.start, '$'),
+                         lexer.Automaton.DEAD)
+        self.assertTrue(automaton.accepts[lexer.Automaton.DEAD] is None)
+
+
+class TestLazyAutomaton(unittest.TestCase):
+
+    def test_lazy_matches_dfa(self):
+        self.assertEqual(lex(SOURCE, mode=lexer.LAZY), lex(SOURCE))
+
+    def test_flush_over_budget(self):
+        out = Output()
+        lazy = lexer.Lexer(initial_state=python_lexer.Main, output=out,
+                           mode=lexer.LAZY, max_dfa_states=4)
+        lazy.lex(SOURCE)
+        self.assertTrue(lazy.flushes > 0)
+        self.assertEqual(tokens_of(out.tokens), lex(SOURCE))
+        for automaton in lazy.automata.values():
+            self.assertTrue(len(automaton) <= 4)
+
+        # The flushed states are freed: (a|b)*a(a|b){14}; has 2**15 of them.
+        generator = random.Random(0)
+        lines = [[generator.choice('ab') for _ in range(60)] + [';\n']
+                 for _ in range(300)]
+        for line in lines:
+            line[-16] = 'a'
+        gc.collect()
+        before = len(lexer.Language.interned)
+        lazy = lexer.Lexer(initial_state=Suffixes, output=Output(),
+                           mode=lexer.LAZY, max_dfa_states=200)
+        lazy.lex(''.join(''.join(_) for _ in lines))
+        self.assertTrue(lazy.flushes > 0)
+        del lazy
+        gc.collect()
+        self.assertTrue(len(lexer.Language.interned) < before + 100)
+
+    def test_steady_state(self):
+        lazy = lexer.Lexer(initial_state=python_lexer.Main, output=Output(),
+                           mode=lexer.LAZY)
+        lazy.feed(SOURCE)
+        sizes = [len(_) for _ in lazy.automata.values()]
+        lazy.feed(SOURCE)
+        self.assertEqual([len(_) for _ in lazy.automata.values()], sizes)
+        self.assertEqual(lazy.flushes, 0)
+
+
+class Suffixes(lexer.State):
+
+    def __init__(self):
+        super(Suffixes, self).__init__()
+        a_or_b = lexer.Or.make(lexer.Character('a'), lexer.Character('b'))
+        language = lexer.Character(';')
+        for _ in range(14):
+            language = lexer.And.make(a_or_b, language)
+        language = lexer.And.make(lexer.Character('a'), language)
+        self.on(lexer.And.make(a_or_b * lexer._, language)).emit(Word)
+        self.on('\n').emit(Word)
+
+
+class Repeats(lexer.State):
+
+    def __init__(self):
+        super(Repeats, self).__init__()
+        a = lexer.Character('a')
+        self.on(a * lexer._ + a * lexer._ + lexer.Character('b')).emit(Word)
+
+
+class TestMinimize(unittest.TestCase):
+
+    def test_merges_equivalent_states(self):
+        automaton = Repeats().compile()
+        minimal = Repeats().compile(minimize=True)
+        self.assertTrue(len(minimal) < len(automaton))
+        self.assertEqual(lex('aabbab', Repeats, minimize=True),
+                         lex('aabbab', Repeats))
+
+    def test_same_tokens(self):
+        self.assertEqual(lex(SOURCE, minimize=True), lex(SOURCE))
+
+    def test_complete_classes(self):
+        classes = python_lexer.Main().compile(minimize=True).classes
+        self.assertTrue(classes.starts is not None)
+        self.assertEqual(classes.of(u'\u00e9'), classes.of(u'\U0001f600'))
+        self.assertNotEqual(classes.of(u'\u00e9'), classes.of('a'))
+
+
+class TestCompiledCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = lexer.CACHE_DIRECTORY
+        lexer.CACHE_DIRECTORY = tempfile.mkdtemp(dir=self.directory)
+
+    def tearDown(self):
+        lexer.CACHE_DIRECTORY = self.directory
+
+    def test_loads_cached_tables(self):
+        language = python_lexer.Main().merged()
+        compiled = lexer.compiled(language)
+        self.assertEqual(len(os.listdir(lexer.CACHE_DIRECTORY)), 1)
+
+        loaded = lexer.compiled(language)
+        self.assertFalse(loaded is compiled)
+        self.assertEqual(loaded.class_transitions, compiled.class_transitions)
+        self.assertEqual(loaded.accepts, compiled.accepts)
+        self.assertTrue(loaded.states[loaded.start] is language)
+
+    def test_key(self):
+        language = Repeats().merged()
+        path = lexer.cache_path(language, False)
+        self.assertEqual(path, lexer.cache_path(Repeats().merged(), False))
+        self.assertNotEqual(path, lexer.cache_path(language, True))
+        self.assertNotEqual(path, lexer.cache_path(Arrows().merged(), False))
+
+        import syntax
+        version = syntax.__version__
+        syntax.__version__ = version + '.dev'
+        try:
+            self.assertNotEqual(path, lexer.cache_path(language, False))
+        finally:
+            syntax.__version__ = version
+
+        code = lexer.code_digest()
+        lexer.CODE_DIGEST = code[::-1]
+        try:
+            self.assertNotEqual(path, lexer.cache_path(language, False))
+        finally:
+            lexer.CODE_DIGEST = code
+
+    def test_loads_canonical_languages(self):
+        # Written with xyzzy built first, loaded with plugh built first: the
+        # alternatives of the Or are ordered the other way round.
+        nodes, ids = lexer.dump_languages([lexer.Or.make(
+            lexer.word('xyzzy'), lexer.word('plugh'))])
+        root = max(ids.values())
+        del ids
+        gc.collect()
+
+        language = lexer.Or.make(lexer.word('plugh'), lexer.word('xyzzy'))
+        self.assertTrue(lexer.load_languages(nodes)[root] is language)
+
+    def test_unreadable_cache(self):
+        language = Arrows().merged()
+        path = lexer.cache_path(language, False)
+        with open(path, 'wb') as f:
+            f.write(b'not marshal')
+        self.assertTrue(lexer.load_automaton(path) is None)
+        self.assertEqual(len(lexer.compiled(language)),
+                         len(lexer.Automaton(language).compile()))
+        self.assertTrue(lexer.load_automaton(path) is not None)
+
+
+class Zeros(lexer.State):
+
+    def __init__(self):
+        super(Zeros, self).__init__()
+        zero = lexer.Character('0')
+        self.on(zero + 'x' | zero + 'y').emit(Word)
+
+
+def random_language(generator, depth):
+    if not depth or generator.random() < 0.3:
+        return generator.choice([lexer.Character('a'), lexer.Character('b'),
+                                 lexer.Character('c'), lexer.RegExp('[bc]'),
+                                 lexer.to_language(['a', 'ab', 'bc'])])
+    left = random_language(generator, depth - 1)
+    right = random_language(generator, depth - 1)
+    return generator.choice([left | right, left + right, left * lexer._,
+                             lexer.Optional(left)])
+
+
+def random_state(generator):
+    state = lexer.State()
+    for token in [Word, Quote, Letter][:generator.randint(1, 3)]:
+        state.on(random_language(generator, 3)).emit(token)
+    return lambda: state
+
+
+def lexed(source, state, **kwargs):
+    try:
+        return lex(source, state, **kwargs)
+    except Exception:
+        return None
+
+
+class TestRegexBackend(unittest.TestCase):
+
+    def test_random_states(self):
+        generator = random.Random(0)
+        for _ in range(300):
+            state = random_state(generator)
+            for _ in range(10):
+                source = ''.join(generator.choice('abc') for _ in
+                                 range(generator.randint(1, 6)))
+                self.assertEqual(lexed(source, state, mode=lexer.REGEX),
+                                 lexed(source, state), source)
+
+    def test_nullable_alternatives(self):
+        a, b = lexer.Character('a'), lexer.Character('b')
+        for language in [a * lexer._ | b, lexer.Optional(a * lexer._),
+                         (lexer.Optional(a) + lexer.Optional(b)) * lexer._]:
+            self.assertTrue(lexer.translate(language, {}) is None)
+
+    def test_same_tokens(self):
+        source = SOURCE + "'''" + 'x' * 1000 + "''' # done\n"
+        self.assertEqual(lex(source, mode=lexer.REGEX), lex(source))
+        self.assertEqual(lex('aabbab', Repeats, mode=lexer.REGEX),
+                         lex('aabbab', Repeats))
+
+    def test_translation(self):
+        masks = lexer.Automaton(python_lexer.Main().merged()).classes
+        masks.complete()
+        masks = dict((atom, set(klass for signature, klass
+                                in masks.ids.items() if signature[i]))
+                     for i, atom in enumerate(masks.atoms))
+        self.assertEqual(lexer.translate(lexer.to_language(['<', '<<', '<=']),
+                                         masks), '(?:<<|<=|<)')
+        self.assertTrue(lexer.translate(python_lexer.identifier, masks))
+        self.assertTrue(lexer.translate(python_lexer.integer, masks) is None)
+
+    def test_rules_fall_back(self):
+        scanner = python_lexer.Main().scanner()
+        fallbacks = [i for i, _ in scanner.fallbacks]
+        rules = python_lexer.Main().rules
+        self.assertTrue(rules[fallbacks[0]].language is
+                        python_lexer.longstring)
+        self.assertTrue(Zeros().scanner() is None)
+        self.assertEqual(lex('0x0y', Zeros, mode=lexer.REGEX),
+                         lex('0x0y', Zeros))
+
+    def test_streaming(self):
+        source = SOURCE * 100
+        path = os.path.join(directory.name, 'source.py')
+        with open(path, 'w') as f:
+            f.write(source)
+        out = Output()
+        lexer.Lexer(initial_state=python_lexer.Main, output=out,
+                    mode=lexer.REGEX).lex_file(path, chunk_size=1000)
+        self.assertEqual(tokens_of(out.tokens), lex(source))
+
+
+@unittest.skipIf(lexer.load_numpy() is None, 'NumPy is not installed')
+class TestVectorize(unittest.TestCase):
+
+    def test_same_tokens(self):
+        source = SOURCE + ' ' * 1000 + "x = '''" + u'é' * 1000 + "'''\n"
+        self.assertEqual(lex(source, vectorize=True), lex(source))
+        self.assertEqual(lex(source, mode=lexer.LAZY, max_dfa_states=4,
+                             vectorize=True), lex(source))
+
+    def test_lone_surrogates(self):
+        # As decoded with surrogateescape.
+        source = "x = '" + 'a\udc80' * 100 + "'\n" + ' ' * 100 + '# \udcff\n'
+        self.assertEqual(lex(source, vectorize=True), lex(source))
+
+    def test_imported_lazily(self):
+        self.assertEqual(imported_with_syntax('numpy'), False)
+
+    def test_run_end(self):
+        source = 'x' + ' ' * 1000 + 'y'
+        automaton = python_lexer.Main().compile()
+        spaces = automaton.step(automaton.step(automaton.start, ' '), ' ')
+        runs = lexer.Runs(source)
+        self.assertEqual(runs.ids.dtype, 'uint8')
+        self.assertEqual(runs.end(automaton, spaces, 2), 1001)
+        self.assertEqual(runs.end(automaton, spaces, 1001), 1001)
+
+        runs = lexer.Runs(source.replace('x', u'\u03bb'))
+        self.assertEqual(runs.ids.dtype, 'uint16')
+        self.assertEqual(runs.end(automaton, spaces, 2), 1001)
+
+    def test_streaming(self):
+        source = SOURCE + ' ' * 100 + SOURCE
+        out = Output()
+        vectorized = lexer.Lexer(initial_state=python_lexer.Main, output=out,
+                                 vectorize=True)
+        for i in range(0, len(source), 7):
+            vectorized.feed(source[i:i + 7])
+        vectorized.done()
+        self.assertEqual(tokens_of(out.tokens), lex(source))
+
+
+class TestDocument(unittest.TestCase):
+
+    def test_edits(self):
+        document = lexer.Document(SOURCE, python_lexer.Main)
+        self.assertEqual(tokens_of(document), lex(SOURCE))
+
+        text = SOURCE
+        for offset, deleted, inserted in [(4, 3, 'spam'), (0, 0, '\n\n'),
+                                          (30, 1, ''), (45, 0, ' "a b"'),
+                                          (len(SOURCE), 0, 'x = 1\n')]:
+            document.edit(offset, deleted, inserted)
+            text = text[:offset] + inserted + text[offset + deleted:]
+            self.assertEqual(document.text, text)
+            self.assertEqual(tokens_of(document), lex(text))
+
+    def test_only_changed_tokens(self):
+        source = SOURCE * 100
+        document = lexer.Document(source, python_lexer.Main)
+        offset = source.index('baz', len(source) // 2)
+        self.assertEqual(document.edit(offset + 1, 0, 'x'),
+                         (document.find(offset), 1, 1))
+        self.assertEqual(document[document.find(offset)].value, 'bxaz')
+        self.assertEqual(document[-1].position, len(source))
+
+    def test_lexer_states(self):
+        document = lexer.Document('a"b"c"d"e', Plain)
+        # The quote before 'b' read it to know it was done.
+        self.assertEqual(document.edit(2, 0, 'x'), (1, 2, 2))
+        self.assertEqual(tokens_of(document), lex('a"xb"c"d"e', Plain))
+
+        # Quoting flips from there on, no boundary lines up again.
+        first, removed, added = document.edit(1, 0, '"')
+        self.assertEqual(first + added, len(document))
+        self.assertEqual(tokens_of(document), lex('a""xb"c"d"e', Plain))
+
+
+    def test_unlexable_edits(self):
+        document = lexer.Document(SOURCE, python_lexer.Main)
+        self.assertRaises(Exception, document.edit, 4, 0, '$')
+        text = SOURCE[:4] + '$' + SOURCE[4:]
+        self.assertEqual(document.text, text)
+
+        # Edits after the failure land where they should, the text still can
+        # not be lexed.
+        self.assertRaises(Exception, document.edit, 6, 0, 'z')
+        text = text[:6] + 'z' + text[6:]
+        self.assertEqual(document.text, text)
+        self.assertEqual(lines_of(document), scanned(document, text))
+
+        document.edit(4, 1, '')
+        text = text[:4] + text[5:]
+        self.assertEqual(document.text, text)
+        self.assertEqual(tokens_of(document), lex(text))
+        self.assertTrue(document.dirty is None)
+
+        # Edits before the failure lex over it again.
+        source = SOURCE * 10
+        document = lexer.Document(source, python_lexer.Main)
+        middle = source.index('bar', len(source) // 2)
+        self.assertRaises(Exception, document.edit, middle, 0, '$')
+        self.assertRaises(Exception, document.edit, 10, 0, 'y')
+        document.edit(middle + 1, 1, '')
+        text = source[:10] + 'y' + source[10:]
+        self.assertEqual(tokens_of(document), lex(text))
+
+        self.assertRaises(Exception, document.edit, len(text), 0, '$')
+        document.edit(len(text), 1, '')
+        self.assertEqual(tokens_of(document), lex(text))
+
+
+class TestParallel(unittest.TestCase):
+
+    def test_same_tokens(self):
+        source = SOURCE * 20
+        self.assertEqual(tokens_of(lexer.lex_parallel(
+            source, python_lexer.Main, processes=2, piece_size=100)),
+            lex(source))
+
+    def test_wrong_guesses(self):
+        # Pieces start at line starts, half of them inside quotes.
+        source = 'a"b\nc"d\n' * 20
+        for piece_size in (3, 5, 7):
+            self.assertEqual(tokens_of(lexer.lex_parallel(
+                source, Plain, processes=2, piece_size=piece_size)),
+                lex(source, Plain))
+
+    def test_imported_lazily(self):
+        self.assertEqual(imported_with_syntax('concurrent.futures'), False)
+
+    def test_error(self):
+        self.assertRaises(Exception, lexer.lex_parallel, 'a\nb\n$\n',
+                          python_lexer.Main, processes=2, piece_size=2)
+
+    def test_extend_buffer(self):
+        first, second = lexer.TokenBuffer(), lexer.TokenBuffer()
+        lexer.Lexer(initial_state=Plain, output=first).lex('a"b"')
+        lexer.Lexer(initial_state=python_lexer.Main, output=second).lex('c d')
+        first.extend(second, 1)
+        self.assertEqual([(type(_).__name__, _.value) for _ in first],
+                         [('Word', 'a'), ('Quote', '"'), ('Word', 'b'),
+                          ('Quote', '"'), ('Whitespace', ' '),
+                          ('Identifier', 'd')])
+
+
+def lines_of(tokens):
+    return [(_.position, _.line, _.column) for _ in tokens]
+
+
+def scanned(tokens, text):
+    return [(_.position, text.count('\n', 0, _.position) + 1,
+             _.position - text.rfind('\n', 0, _.position) - 1)
+            for _ in tokens]
+
+
+class TestLineIndex(unittest.TestCase):
+
+    def test_token_lines(self):
+        out = lexer.Tokens()
+        lexer.Lexer(initial_state=python_lexer.Main, output=out,
+                    index_lines=True).lex(SOURCE)
+        self.assertEqual(lines_of(out), scanned(out, SOURCE))
+
+        out = lexer.Tokens()
+        streamed = lexer.Lexer(initial_state=python_lexer.Main, output=out,
+                               index_lines=True)
+        for i in range(0, len(SOURCE), 5):
+            streamed.feed(SOURCE[i:i + 5])
+        streamed.done()
+        self.assertEqual(lines_of(out), scanned(out, SOURCE))
+        self.assertEqual(list(streamed.lines.starts),
+                         list(lexer.LineIndex(SOURCE).starts))
+
+    def test_token_buffer(self):
+        buffer = lexer.TokenBuffer()
+        lexer.Lexer(initial_state=python_lexer.Main, output=buffer,
+                    index_lines=True).lex(SOURCE)
+        self.assertEqual(lines_of(buffer), scanned(buffer, SOURCE))
+
+        source = SOURCE * 10
+        buffer = lexer.lex_parallel(source, python_lexer.Main, processes=2,
+                                    piece_size=100)
+        self.assertEqual(lines_of(buffer), scanned(buffer, source))
+
+    def test_edit(self):
+        lines = lexer.LineIndex(SOURCE)
+        lines.edit(10, 30, 'a\nb\n\n')
+        text = SOURCE[:10] + 'a\nb\n\n' + SOURCE[40:]
+        self.assertEqual(list(lines), list(lexer.LineIndex(text)))
+
+        document = lexer.Document(SOURCE, python_lexer.Main)
+        document.edit(10, 30, 'a\nb\n\n')
+        self.assertEqual(lines_of(document), scanned(document, text))
+
+    def test_random_edits(self):
+        generator = random.Random(0)
+        text = SOURCE
+        lines = lexer.LineIndex(text)
+        for _ in range(200):
+            offset = generator.randrange(len(text) + 1)
+            deleted = generator.randrange(min(10, len(text) - offset) + 1)
+            inserted = ''.join(generator.choice('ab\n')
+                               for _ in range(generator.randrange(10)))
+            lines.edit(offset, deleted, inserted)
+            text = text[:offset] + inserted + text[offset + deleted:]
+            offset = generator.randrange(len(text) + 1)
+            self.assertEqual(lines.line(offset), text[:offset].count('\n') + 1)
+            self.assertEqual(lines.column(offset),
+                             offset - text.rfind('\n', 0, offset) - 1)
+        self.assertEqual(list(lines), list(lexer.LineIndex(text)))
+
+    def test_error_position(self):
+        with self.assertRaises(Exception) as raised:
+            lex('a = 1\nb = $\n', index_lines=True)
+        self.assertTrue('(line 2, column 4)' in str(raised.exception))
+
+
+class TestHashConsing(unittest.TestCase):
+
+    def test_same_structure_same_instance(self):
+        self.assertTrue(lexer.Character('a') is lexer.Character('a'))
+        self.assertTrue(lexer.word('while') is lexer.word('while'))
+        self.assertTrue(lexer.RegExp('[a-z]') is lexer.RegExp('[a-z]'))
+
+    def test_or_normal_form(self):
+        a, b, c = [lexer.Character(_) for _ in 'abc']
+        self.assertTrue(lexer.Or.make(a, b) is lexer.Or.make(b, a))
+        self.assertTrue(lexer.Or.make(lexer.Or.make(a, b), c) is
+                        lexer.Or.make(a, lexer.Or.make(c, b)))
+        self.assertTrue(lexer.Or.make(lexer.Or.make(a, b), a) is
+                        lexer.Or.make(a, b))
+        self.assertTrue(lexer.Or.make(a, a) is a)
+
+    def test_literals_from_list(self):
+        literals = lexer.Literals(['if', 'else'])
+        self.assertTrue(literals is lexer.Literals(('else', 'if')))
+        language = literals | 'x'
+        self.assertTrue(language.derive('x') is lexer.match)
+        self.assertTrue(language.derive('i').derive('f').nullable)
+
+    def test_nested_star(self):
+        a = lexer.Character('a')
+        star = lexer.Star.make(a)
+        self.assertTrue(lexer.Star.make(star) is star)
+        self.assertTrue(lexer.Star.make(lexer.Optional.make(a)) is star)
+        self.assertTrue(lexer.Optional.make(star) is star)
+
+    def test_bounded_derivatives(self):
+        derivative = python_lexer.identifier.derive('a')
+        self.assertTrue(derivative.derive('b') is derivative)
+        derivative = python_lexer.comments.derive('#')
+        self.assertTrue(derivative.derive('x').derive('y') is derivative)
+
+
+class TestDerivativeCache(unittest.TestCase):
+
+    def test_memoized(self):
+        language = lexer.RegExp('[0-9]') + lexer._
+        first = language.derive('1')
+        before = lexer.Language.cache_info()
+        self.assertTrue(language.derive('1') is first)
+        after = lexer.Language.cache_info()
+        self.assertEqual(after.hits, before.hits + 1)
+        self.assertTrue(0.0 < after.hit_rate <= 1.0)
+
+    def test_bounded(self):
+        language = lexer.RegExp('.') * lexer._
+        for i in range(lexer.Language.cache_size + 10):
+            language.derive(chr(i + 256))
+        self.assertEqual(len(language.derivatives), lexer.Language.cache_size)
+        self.assertTrue(chr(256) not in language.derivatives)
+
+
+class TestStatus(unittest.TestCase):
+
+    def test_nullable(self):
+        a, b = lexer.Character('a'), lexer.Character('b')
+        self.assertFalse((a + b).nullable)
+        self.assertTrue((a * lexer._ + b * lexer._).nullable)
+        self.assertTrue(lexer.Or.make(a, lexer.Star.make(b)).nullable)
+
+    def test_derived_status(self):
+        state = Arrows()
+        context = lexer.Lexer(initial_state=Arrows, mode=lexer.DERIVATIVE)
+        context.feed('--')
+        dash = state.next('-', context)
+        self.assertEqual(dash.status, lexer.ACCEPT)
+        self.assertEqual(dash.next('-', context).status, lexer.CONTINUE)
+        self.assertEqual(dash.next('x', context).status, lexer.REJECT)
+
+
+class TestMergedLanguage(unittest.TestCase):
+
+    def test_exact_match_wins(self):
+        a = lexer.Character('a')
+        language = lexer.tagged([lexer.Star.make(a), a]).derive('a')
+        self.assertEqual(lexer.winner(language), 1)
+        self.assertEqual(lexer.winner(language.derive('a')), 0)
+        self.assertTrue(lexer.winner(language.derive('b')) is None)
+
+    def test_first_rule_wins(self):
+        a = lexer.Character('a')
+        language = lexer.tagged([a, a]).derive('a')
+        self.assertEqual(len(lexer.Or.alternatives(language)), 2)
+        self.assertEqual(lexer.winner(language), 0)
+
+    def test_one_language_per_state(self):
+        state = Arrows()
+        context = lexer.Lexer(initial_state=Arrows, mode=lexer.DERIVATIVE)
+        context.feed('-->')
+        dash = state.next('-', context)
+        self.assertTrue(dash.language is state.merged().derive('-'))
+        self.assertEqual(dash.rule_index(), 0)
+        arrow = dash.next('-', context).next('>', context)
+        self.assertTrue(arrow.has_exact_match())
+        self.assertEqual(arrow.rule_index(), 1)
+
+
+class TestLiterals(unittest.TestCase):
+
+    def test_trie(self):
+        literals = lexer.to_language(['*', '**', '*='])
+        star = literals.derive('*')
+        self.assertTrue(star.nullable)
+        self.assertTrue(star.derive('*') is lexer.match)
+        self.assertTrue(star.derive('=') is lexer.match)
+        self.assertTrue(literals.derive('=') is lexer.reject)
+        self.assertTrue(literals is lexer.Literals.make(('**', '*=', '*')))
+
+    def test_keyword_table(self):
+        self.assertEqual(lex('print printer in'),
+                         [('Keyword', 'print', 0),
+                          ('Whitespace', ' ', 5),
+                          ('Identifier', 'printer', 6),
+                          ('Whitespace', ' ', 13),
+                          ('Keyword', 'in', 14)])
+
+
+class TestCharacterClasses(unittest.TestCase):
+
+    def test_partition(self):
+        classes = lexer.CharacterClasses(lexer.atoms([python_lexer.identifier]))
+        self.assertEqual(classes.of('a'), classes.of('Z'))
+        self.assertNotEqual(classes.of('a'), classes.of('1'))
+        self.assertNotEqual(classes.of('_'), classes.of('1'))
+        self.assertEqual(classes.of(u'\u00e9'), classes.of('$'))
+
+    def test_no_regexp_per_character(self):
+        calls = [0]
+        derive = lexer.RegExp._derive
+
+        def counting_derive(language, ch):
+            calls[0] += 1
+            return derive(language, ch)
+
+        lexer.RegExp._derive = counting_derive
+        try:
+            source = "x = '" + u'\u00e9' * 5000 + "'\n"
+            self.assertEqual(len(lex(source)), 6)
+        finally:
+            lexer.RegExp._derive = derive
+        self.assertTrue(calls[0] < 100, calls[0])
+
+
+class TestTokenize(unittest.TestCase):
+
+    def tokenize(self, chunks):
+        tokens = lexer.Lexer(initial_state=python_lexer.Main).tokenize(chunks)
+        return tokens_of(tokens)
+
+    def test_string_chunks(self):
+        chunks = [SOURCE[i:i + 7] for i in range(0, len(SOURCE), 7)]
+        self.assertEqual(self.tokenize(chunks), lex(SOURCE))
+
+    def test_bytes_chunks(self):
+        source = SOURCE + '# caf\u00e9\n'
+        data = source.encode('utf-8')
+        chunks = [data[i:i + 3] for i in range(0, len(data), 3)]
+        self.assertEqual(self.tokenize(chunks), lex(source))
+
+    def test_yields_before_the_end(self):
+        tokens = lexer.Lexer(initial_state=python_lexer.Main).tokenize(
+            iter(['if x', ' or y', None]))
+        self.assertEqual(next(tokens).value, 'if')
+
+    def test_bounded_window(self):
+        lexer_ = lexer.Lexer(initial_state=python_lexer.Main,
+                             max_token_size=100)
+        chunks = ('x = 1\n' for _ in range(10000))
+        count = 0
+        for token in lexer_.tokenize(chunks):
+            count += 1
+            self.assertTrue(len(lexer_.buffer) < 100)
+        self.assertEqual(count, 60000)
+
+    def test_flat_memory(self):
+        lexer_ = lexer.Lexer(initial_state=python_lexer.Main,
+                             max_token_size=100)
+        chunks = ('x = 1\n' for _ in range(20000))
+        tracemalloc.start()
+        try:
+            for count, token in enumerate(lexer_.tokenize(chunks)):
+                if count == 30000:
+                    used = tracemalloc.get_traced_memory()[0]
+            grown = tracemalloc.get_traced_memory()[0] - used
+        finally:
+            tracemalloc.stop()
+        self.assertTrue(grown < 64 * 1024, grown)
+        self.assertTrue(token.line is None)
+
+    def test_token_too_long(self):
+        lexer_ = lexer.Lexer(initial_state=python_lexer.Main,
+                             max_token_size=100)
+        chunks = ['x = "'] + ['y' * 10] * 20 + ['"']
+        self.assertRaises(lexer.TokenTooLong, list, lexer_.tokenize(chunks))
+
+        lexer_ = lexer.Lexer(initial_state=python_lexer.Main,
+                             max_token_size=100)
+        self.assertRaises(lexer.TokenTooLong, lexer_.lex, 'x' * 101)
+
+
+class TestLexFile(unittest.TestCase):
+
+    def lex_file(self, data, **kwargs):
+        fd, path = tempfile.mkstemp()
+        try:
+            os.write(fd, data)
+            os.close(fd)
+            out = Output()
+            lexer.Lexer(initial_state=python_lexer.Main,
+                        output=out).lex_file(path, **kwargs)
+            return tokens_of(out.tokens)
+        finally:
+            os.remove(path)
+
+    def test_lex_file(self):
+        source = SOURCE + '# caf\u00e9\n'
+        self.assertEqual(self.lex_file(source.encode('utf-8'), chunk_size=5),
+                         lex(source))
+
+    def test_empty_file(self):
+        self.assertEqual(self.lex_file(b''), [])
+
+
+class Statement(parser.Grammar):
+
+    def main(self):
+        return parser.And(parser.TokenClass(python_lexer.Keyword),
+                          parser.TokenClass(python_lexer.Identifier))
+
+
+class TestTokenBuffer(unittest.TestCase):
+
+    def test_same_tokens(self):
+        buffer = lexer.TokenBuffer()
+        lexer.Lexer(initial_state=python_lexer.Main, output=buffer).lex(SOURCE)
+        self.assertEqual(tokens_of(buffer), lex(SOURCE))
+        self.assertEqual(buffer.text(), SOURCE)
+        self.assertEqual(buffer[-1].value, '\n')
+
+    def test_grammar_derive(self):
+        buffer = lexer.TokenBuffer()
+        for token_type, value, skip in [(python_lexer.Keyword, 'if', False),
+                                        (python_lexer.Whitespace, ' ', True),
+                                        (python_lexer.Identifier, 'x', False)]:
+            token = token_type(skip=skip)
+            token.value = value
+            token.position = 0
+            buffer.add(token)
+
+        d = Statement().derive(buffer)
+        self.assertTrue(d.is_matchable())
+        self.assertEqual([_.value for _ in d.ast()], ['if', 'x'])
+
+
+class TestToken(unittest.TestCase):
+
+    def test_slots(self):
+        token = python_lexer.Keyword()
+        self.assertFalse(hasattr(token, '__dict__'))
+        self.assertEqual((token.value, token.position, token.skip),
+                         (None, None, False))
+
+    def test_create(self):
+        token = python_lexer.Keyword.create('if', 3, True)
+        self.assertTrue(isinstance(token, python_lexer.Keyword))
+        self.assertEqual((token.value, token.position, token.skip),
+                         ('if', 3, True))
+
+    def test_emit_skip(self):
+        class Skipping(lexer.State):
+            def __init__(self):
+                super(Skipping, self).__init__()
+                self.on(lexer.RegExp('[a-z]') + lexer._).emit(Word)
+                self.on(' ').emit(Word, skip=True)
+
+        out = Output()
+        lexer.Lexer(initial_state=Skipping, output=out).lex('ab c')
+        self.assertEqual([_.skip for _ in out.tokens], [False, True, False])
+
+
+class Word(lexer.Token): pass
+class Quote(lexer.Token): pass
+
+
+class Quoted(lexer.State):
+    built = 0
+
+    def __init__(self, marker):
+        super(Quoted, self).__init__()
+        Quoted.built += 1
+        self.on(marker).emit_then_switch_to(Quote, Plain)
+        self.on(lexer.RegExp('[^' + marker + ']') * lexer._).emit(Word)
+
+
+class Plain(lexer.State):
+    built = 0
+
+    def __init__(self):
+        super(Plain, self).__init__()
+        Plain.built += 1
+        self.on('"').emit_then_switch_to(Quote, lambda: Quoted('"'))
+        self.on(lexer.RegExp('[^"]') + lexer._).emit(Word)
+
+
+class TestStateReuse(unittest.TestCase):
+
+    def setUp(self):
+        Plain.built = Quoted.built = 0
+
+    def test_states_built_once_per_lexer(self):
+        for mode in (lexer.DFA, lexer.DERIVATIVE):
+            tokens = lex('a"b"c"d"e', Plain, mode=mode)
+            self.assertEqual([_[1] for _ in tokens],
+                             ['a', '"', 'b', '"', 'c', '"', 'd', '"', 'e'])
+        self.assertEqual((Plain.built, Quoted.built), (2, 2))
+
+
+class Dash(lexer.Token): pass
+class Arrow(lexer.Token): pass
+class Letter(lexer.Token): pass
+
+
+class Arrows(lexer.State):
+
+    def __init__(self):
+        super(Arrows, self).__init__()
+        self.on('-').emit(Dash)
+        self.on('-->').emit(Arrow)
+        self.on(lexer.Character('-') + lexer._ + lexer.Character('>')).emit(Arrow)
+        self.on(lexer.RegExp('[a-z]')).emit(Letter)
+
+
+class TestBacktracking(unittest.TestCase):
+
+    def test_rewinds_to_last_accepting_state(self):
+        for mode in (lexer.DFA, lexer.DERIVATIVE):
+            self.assertEqual(lex('--x-->', Arrows, mode=mode),
+                             [('Dash', '-', 0), ('Dash', '-', 1),
+                              ('Letter', 'x', 2), ('Arrow', '-->', 3)])
+
+    def test_near_misses_stay_linear(self):
+        steps = [0]
+        next_ = lexer.AutomatonState.next
+
+        def counting_next(state, ch, context):
+            steps[0] += 1
+            return next_(state, ch, context)
+
+        lexer.AutomatonState.next = counting_next
+        try:
+            tokens = lex('-' * 2000, Arrows)
+        finally:
+            lexer.AutomatonState.next = next_
+
+        self.assertEqual(len(tokens), 2000)
+        self.assertTrue(steps[0] < 5 * 2000, steps[0])
+
+    def test_no_recursion(self):
+        tokens = lex('-' * 20000 + 'x' * 20000, Arrows)
+        self.assertEqual(len(tokens), 40000)
+
+
+if __name__ == '__main__':
+    unittest.main()